@@ -3,9 +3,10 @@ import torch.nn as nn
 from functools import partial
 import clip
 from einops import rearrange, repeat
-from transformers import CLIPTokenizer, CLIPTextModel
+from transformers import CLIPTokenizer, CLIPTextModel, CLIPTextConfig
 import kornia
 
+from ldm.util import skipping_init
 from ldm.modules.x_transformer import Encoder, TransformerWrapper  # TODO: can we directly rely on lucidrains code and simply add this as a reuirement? --> test
 
 
@@ -139,7 +140,16 @@ class FrozenCLIPEmbedder(AbstractEncoder):
     def __init__(self, version="openai/clip-vit-large-patch14", device="cuda", max_length=77):
         super().__init__()
         self.tokenizer = CLIPTokenizer.from_pretrained(version)
-        self.transformer = CLIPTextModel.from_pretrained(version)
+        if skipping_init():
+            # The weights come from the checkpoint, only the architecture is needed
+            try:
+                from transformers.modeling_utils import no_init_weights
+            except ImportError:
+                from contextlib import nullcontext as no_init_weights
+            with no_init_weights():
+                self.transformer = CLIPTextModel(CLIPTextConfig.from_pretrained(version))
+        else:
+            self.transformer = CLIPTextModel.from_pretrained(version)
         self.device = device
         self.max_length = max_length
         self.freeze()
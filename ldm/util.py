@@ -4,7 +4,8 @@ import torch
 import numpy as np
 from collections import abc
 from einops import rearrange
-from functools import partial
+from functools import partial, partialmethod
+from contextlib import contextmanager
 
 import multiprocessing as mp
 from threading import Thread
@@ -75,16 +76,111 @@ def count_params(model, verbose=False):
     return total_params
 
 
-def instantiate_from_config(config):
+def instantiate_from_config(config, empty=False):
     if not "target" in config:
         if config == '__is_first_stage__':
             return None
         elif config == "__is_unconditional__":
             return None
         raise KeyError("Expected key `target` to instantiate.")
+    if empty:
+        with skip_init():
+            return get_obj_from_str(config["target"])(**config.get("params", dict()))
     return get_obj_from_str(config["target"])(**config.get("params", dict()))
 
 
+_skip_init_depth = 0
+
+_skip_init_modules = [torch.nn.Linear, torch.nn.Conv1d, torch.nn.Conv2d, torch.nn.Conv3d, torch.nn.ConvTranspose1d,
+                      torch.nn.ConvTranspose2d, torch.nn.ConvTranspose3d, torch.nn.LayerNorm, torch.nn.GroupNorm,
+                      torch.nn.Embedding, torch.nn.MultiheadAttention]
+
+# Names of the weight initialization of those classes, MultiheadAttention keeps its own private
+_reset_names = ["reset_parameters", "_reset_parameters"]
+
+
+def skipping_init():
+    return _skip_init_depth > 0
+
+
+@contextmanager
+def skip_init():
+    """
+    Construct modules without initializing or allocating their weights, for models whose weights are all loaded from a
+    checkpoint right after. Linear, convolution, normalization and embedding layers get their parameters on the meta
+    device, as do the fused projections of multi-head attention. The checkpoint tensors replace them and anything it
+    does not cover has to go through init_missing.
+    """
+    global _skip_init_depth
+    if _skip_init_depth > 0:
+        _skip_init_depth += 1
+        try:
+            yield
+        finally:
+            _skip_init_depth -= 1
+        return
+
+    # Patch the classes that define the initialization, convolutions inherit theirs from _ConvNd
+    owners = []
+    for cls in _skip_init_modules:
+        owner = next((base, name) for base in cls.__mro__ for name in _reset_names if name in base.__dict__)
+        if owner not in owners:
+            owners.append(owner)
+    originals = [(cls, name, cls.__dict__[name]) for cls, name in owners]
+    for cls, name, _ in originals:
+        setattr(cls, name, lambda self: None)
+
+    # All of them take a device for their parameters, which is forced to meta
+    constructors = [(cls, cls.__dict__["__init__"]) for cls in _skip_init_modules]
+    for cls, constructor in constructors:
+        cls.__init__ = partialmethod(_meta_init, constructor)
+    _skip_init_depth += 1
+    try:
+        yield
+    finally:
+        _skip_init_depth -= 1
+        for cls, name, reset_parameters in originals:
+            setattr(cls, name, reset_parameters)
+        for cls, constructor in constructors:
+            cls.__init__ = constructor
+
+
+def _meta_init(self, constructor, *args, **kwargs):
+    kwargs["device"] = "meta"
+    constructor(self, *args, **kwargs)
+
+
+def init_missing(model, keys):
+    # Run the regular initialization for modules owning parameters a checkpoint did not provide
+    # Tensors of those modules that were loaded are swapped for scratch copies meanwhile, so only the missing ones change
+    # Missing tensors still on the meta device from skip_init are allocated on the CPU first
+    missing = set(keys)
+    owners = set(key.rpartition(".")[0] for key in keys)
+    for name in owners:
+        try:
+            module = model.get_submodule(name)
+        except AttributeError:
+            continue
+        reset_parameters = next((getattr(module, method) for method in _reset_names if hasattr(module, method)), None)
+        if reset_parameters is None:
+            continue
+
+        # MultiheadAttention also initializes its output projection, so loaded tensors of submodules are kept aside too
+        loaded = []
+        for tensor_name, tensor in list(module.named_parameters()) + list(module.named_buffers()):
+            if (f"{name}.{tensor_name}" if name else tensor_name) not in missing:
+                loaded.append((tensor, tensor.data))
+                tensor.data = torch.empty_like(tensor.data)
+            elif tensor.is_meta and tensor_name in module._parameters:
+                module._parameters[tensor_name] = torch.nn.Parameter(torch.empty_like(tensor, device="cpu"), requires_grad=tensor.requires_grad)
+            elif tensor.is_meta and tensor_name in module._buffers:
+                module._buffers[tensor_name] = torch.empty_like(tensor, device="cpu")
+        reset_parameters()
+        for tensor, data in loaded:
+            tensor.data = data
+    return len(owners)
+
+
 def get_obj_from_str(string, reload=False):
     module, cls = string.rsplit(".", 1)
     if reload:
@@ -0,0 +1,219 @@
+import os, json, struct, argparse
+import torch
+import numpy as np
+from torch.nn.modules.module import _IncompatibleKeys
+
+# Pre-split checkpoint format
+# A small JSON index followed by raw tensor data, every tensor aligned so it can be mapped straight into memory.
+# Tensors are already renamed and grouped per sub-model and stored in the dtype they are used at.
+# The header records the dtype the UNet and text encoder were converted to.
+
+MAGIC = b"PXLSPLIT"
+ALIGNMENT = 64
+SUFFIX = ".split"
+
+GROUPS = ["model1", "model2", "cond_stage_model", "first_stage_model"]
+
+NUMPY_DTYPES = {
+    "float64": np.float64,
+    "float32": np.float32,
+    "float16": np.float16,
+    "bfloat16": np.int16, # numpy has no bfloat16, the bits are reinterpreted after mapping
+    "int64": np.int64,
+    "int32": np.int32,
+    "uint8": np.uint8,
+    "bool": np.bool_,
+}
+
+TORCH_DTYPES = {
+    "float64": torch.float64,
+    "float32": torch.float32,
+    "float16": torch.float16,
+    "bfloat16": torch.bfloat16,
+    "int64": torch.int64,
+    "int32": torch.int32,
+    "uint8": torch.uint8,
+    "bool": torch.bool,
+}
+
+def split_unet_keys(sd):
+    # Rename "model.*" keys to the encode (model1) and decode (model2) halves of the split UNet, in place
+    li, lo = [], []
+    for key, value in sd.items():
+        sp = key.split(".")
+        if (sp[0]) == "model":
+            if "input_blocks" in sp:
+                li.append(key)
+            elif "middle_block" in sp:
+                li.append(key)
+            elif "time_embed" in sp:
+                li.append(key)
+            else:
+                lo.append(key)
+
+    for key in li:
+        sd["model1." + key[6:]] = sd.pop(key)
+    for key in lo:
+        sd["model2." + key[6:]] = sd.pop(key)
+    return sd
+
+def group_of(key):
+    # Sub-model a key belongs to, keys shared by all of them (noise schedule buffers) go to "common"
+    prefix = key.split(".")[0]
+    return prefix if prefix in GROUPS else "common"
+
+def align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+def load_checkpoint(path):
+    # Map the checkpoint instead of reading it whole where torch supports it (2.1 and later), tensors are then paged in as they are used
+    # Older versions read the whole checkpoint, only pre-split checkpoints keep the peak memory close to the final size there
+    try:
+        sd = torch.load(path, map_location="cpu", mmap=True)
+    except (TypeError, RuntimeError):
+        sd = torch.load(path, map_location="cpu")
+    if "state_dict" in sd:
+        sd = sd["state_dict"]
+    return sd
+
+def cast_state_dict(sd, dtypes):
+    # Cast the tensors of each group to the dtype given for it, one tensor at a time so the originals are freed as we go
+    # EMA weights are never used for inference and are dropped
+    for key in list(sd):
+        tensor = sd[key]
+        if not isinstance(tensor, torch.Tensor) or key.startswith("model_ema."):
+            del sd[key]
+            continue
+        dtype = dtypes.get(group_of(key))
+        if dtype is not None and tensor.is_floating_point() and tensor.dtype != dtype:
+            sd[key] = tensor.to(dtype)
+    return sd
+
+def convert(source, destination, dtype=torch.float16):
+    # Load a regular checkpoint once and write it out in the pre-split format
+    # The first stage and the schedule buffers always run at full precision
+    sd = cast_state_dict(split_unet_keys(load_checkpoint(source)), {"model1": dtype, "model2": dtype, "cond_stage_model": dtype, "first_stage_model": torch.float32, "common": torch.float32})
+
+    index = {}
+    tensors = []
+    offset = 0
+    for key, tensor in sd.items():
+        group = group_of(key)
+        tensor = tensor.contiguous()
+        name = str(tensor.dtype).replace("torch.", "")
+        assert name in NUMPY_DTYPES, f"unsupported dtype {tensor.dtype} for {key}"
+
+        nbytes = tensor.element_size() * tensor.nelement()
+        index[key] = {"group": group, "dtype": name, "shape": list(tensor.shape), "offset": offset, "nbytes": nbytes}
+        tensors.append(tensor)
+        offset = align(offset + nbytes)
+
+    header = json.dumps({"format": 1, "dtype": str(dtype).replace("torch.", ""), "tensors": index}).encode("utf-8")
+    start = align(len(MAGIC) + 8 + len(header))
+
+    with open(destination, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+        for (key, entry), tensor in zip(index.items(), tensors):
+            f.seek(start + entry["offset"])
+            if tensor.dtype == torch.bfloat16:
+                tensor = tensor.view(torch.int16)
+            f.write(tensor.numpy().tobytes())
+        f.truncate(start + offset)
+
+def read_header(path):
+    # Index of a pre-split checkpoint and the offset its tensor data starts at
+    with open(path, "rb") as f:
+        assert f.read(len(MAGIC)) == MAGIC, f"{path} is not a pre-split checkpoint"
+        length, = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(length).decode("utf-8"))
+    return header, align(len(MAGIC) + 8 + length)
+
+def stored_dtype(header):
+    # Dtype the UNet was converted to, files from before it was recorded are read off their UNet tensors
+    if "dtype" in header:
+        return TORCH_DTYPES[header["dtype"]]
+    for entry in header["tensors"].values():
+        if entry["group"] == "model1" and TORCH_DTYPES[entry["dtype"]].is_floating_point:
+            return TORCH_DTYPES[entry["dtype"]]
+    return torch.float32
+
+def find_split(path, dtype=None):
+    # Pre-split copy written next to a checkpoint, used when it is at least as new as the original
+    # A copy stored at lower precision than dtype would lose what the original has, the original is loaded instead if it is there
+    split = path + SUFFIX
+    if not os.path.isfile(split):
+        return None
+    if not os.path.isfile(path):
+        return split
+    if os.path.getmtime(split) < os.path.getmtime(path):
+        return None
+    if dtype is not None and torch.finfo(stored_dtype(read_header(split)[0])).eps > torch.finfo(dtype).eps:
+        return None
+    return split
+
+def load_split(path, dtypes={}):
+    # Map a pre-split checkpoint into memory, returning a state dict per group
+    # Tensors share the mapped pages, only groups requested in another dtype in dtypes are copied
+    header, start = read_header(path)
+
+    # Copy-on-write mapping, pages are read from disk when a tensor is first touched
+    data = np.memmap(path, dtype=np.uint8, mode="c")
+
+    groups = {group: {} for group in GROUPS + ["common"]}
+    for key, entry in header["tensors"].items():
+        begin = start + entry["offset"]
+        array = data[begin:begin + entry["nbytes"]].view(NUMPY_DTYPES[entry["dtype"]]).reshape(entry["shape"])
+        tensor = torch.from_numpy(array)
+        if entry["dtype"] == "bfloat16":
+            tensor = tensor.view(torch.bfloat16)
+
+        dtype = dtypes.get(entry["group"])
+        if dtype is not None and tensor.is_floating_point() and tensor.dtype != dtype:
+            tensor = tensor.to(dtype)
+        groups[entry["group"]][key] = tensor
+    return groups
+
+def assign_state_dict(module, sd):
+    # Point parameters and buffers at the given tensors instead of copying into the ones the module allocated
+    # Parameters built on the meta device have no data to point elsewhere and are replaced by new ones
+    for key, tensor in sd.items():
+        path, _, name = key.rpartition(".")
+        try:
+            owner = module.get_submodule(path)
+        except AttributeError:
+            continue
+        if owner._parameters.get(name) is not None:
+            target = owner._parameters[name]
+        elif owner._buffers.get(name) is not None:
+            target = owner._buffers[name]
+        else:
+            continue
+        if target.shape != tensor.shape:
+            raise RuntimeError(f"size mismatch for {key}: copying a param with shape {tuple(tensor.shape)}, the shape in current model is {tuple(target.shape)}")
+        if name in owner._parameters and target.is_meta:
+            owner._parameters[name] = torch.nn.Parameter(tensor, requires_grad=target.requires_grad)
+        elif name in owner._parameters:
+            target.data = tensor
+        else:
+            owner._buffers[name] = tensor
+    return module
+
+def run_load_hooks(module, missing):
+    # Call the load_state_dict post hooks that load_state_dict would have, after assign_state_dict and init_missing
+    # Some modules derive tensors from loaded ones there, like the fused projection of splitAttention's SelfAttention
+    keys = _IncompatibleKeys(list(missing), [])
+    for submodule in module.modules():
+        for hook in submodule._load_state_dict_post_hooks.values():
+            hook(submodule, keys)
+    return module
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert a checkpoint to the pre-split memory-mappable format")
+    parser.add_argument("checkpoint", type=str, help="checkpoint to convert, the result is written next to it")
+    parser.add_argument("--precision", type=str, choices=["half", "full"], default="half", help="precision to store the UNet and text encoder at")
+    opt = parser.parse_args()
+
+    convert(opt.checkpoint, opt.checkpoint + SUFFIX, torch.float16 if opt.precision == "half" else torch.float32)
+    print(f"Wrote {opt.checkpoint + SUFFIX}")
@@ -6,7 +6,8 @@ https://github.com/CompVis/taming-transformers
 -- merci
 """
 
-import time, math, sys, os
+import time, math, sys, os, itertools, threading
+from collections import OrderedDict
 from tqdm.auto import trange, tqdm
 import torch
 from einops import rearrange
@@ -338,8 +339,89 @@ class FirstStage(DDPM):
             return self.first_stage_model.encode(x)
 
 
+class Cancelled(Exception):
+    """Raised inside a job that was cancelled, unwinding it without producing results."""
+
+
+class CancelToken:
+    """Per-job cancellation flag, set from the server thread and checked by the job between units of work."""
+    def __init__(self):
+        self.event = threading.Event()
+
+    def cancel(self):
+        self.event.set()
+
+    @property
+    def cancelled(self):
+        return self.event.is_set()
+
+    def check(self):
+        if self.event.is_set():
+            raise Cancelled()
+
+
+class CancelGroup:
+    """Cancellation of work shared by several jobs, set only once every one of them was cancelled."""
+    def __init__(self, tokens):
+        self.tokens = list(tokens)
+
+    @property
+    def cancelled(self):
+        return all(token is not None and token.cancelled for token in self.tokens)
+
+    def check(self):
+        if self.cancelled:
+            raise Cancelled()
+
+
+class ConditioningCache:
+    """LRU cache of learned conditionings, bounded by the memory held by the cached tensors."""
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        size = value.element_size() * value.nelement()
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            old = self.entries.pop(key)
+            self.bytes -= old.element_size() * old.nelement()
+        self.entries[key] = value
+        self.bytes += size
+
+        # evict least recently used entries until the cache fits its budget again
+        while self.bytes > self.max_bytes:
+            _, old = self.entries.popitem(last=False)
+            self.bytes -= old.element_size() * old.nelement()
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+
+
+cond_stage_ids = itertools.count()
+
+
 class CondStage(DDPM):
     """main class"""
+    # shared by every instance, entries are keyed by the instance that computed them
+    cache = ConditioningCache()
+
     def __init__(self,
                  cond_stage_config,
                  num_timesteps_cond=None,
@@ -372,6 +454,7 @@ class CondStage(DDPM):
         self.cond_stage_forward = cond_stage_forward
         self.clip_denoised = False
         self.bbox_tokenizer = None  
+        self.cache_id = next(cond_stage_ids)
 
         self.restarted_from_ckpt = False
         if ckpt_path is not None:
@@ -399,7 +482,33 @@ class CondStage(DDPM):
             model = instantiate_from_config(config)
             self.cond_stage_model = model
 
+    def conditioning_key(self, c):
+        # only text prompts are cached
+        if isinstance(c, str):
+            texts = (c,)
+        elif isinstance(c, (list, tuple)) and all(isinstance(text, str) for text in c):
+            texts = tuple(c)
+        else:
+            return None
+
+        # the result depends on the precision the encoder runs at and the device it is returned on
+        if torch.is_autocast_enabled():
+            dtype = torch.get_autocast_gpu_dtype()
+        else:
+            dtype = next(self.cond_stage_model.parameters()).dtype
+        device = str(getattr(self.cond_stage_model, "device", None))
+        return (self.cache_id, texts, dtype, device)
+
+    def is_cached(self, c):
+        return self.conditioning_key(c) in self.cache
+
     def get_learned_conditioning(self, c):
+        key = self.conditioning_key(c)
+        if key is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached
+
         if self.cond_stage_forward is None:
             if hasattr(self.cond_stage_model, 'encode') and callable(self.cond_stage_model.encode):
                 c = self.cond_stage_model.encode(c)
@@ -410,6 +519,9 @@ class CondStage(DDPM):
         else:
             assert hasattr(self.cond_stage_model, self.cond_stage_forward)
             c = getattr(self.cond_stage_model, self.cond_stage_forward)(c)
+
+        if key is not None:
+            self.cache.put(key, c)
         return c
 
 class DiffusionWrapper(pl.LightningModule):
@@ -473,6 +585,8 @@ class UNet(DDPM):
         self.model1.eval()
         self.model2.eval()
         self.turbo = False
+        self.residency = None
+        self.cancel = None
         self.unet_bs = unet_bs
         self.restarted_from_ckpt = False
         if ckpt_path is not None:
@@ -504,7 +618,9 @@ class UNet(DDPM):
 
     def apply_model(self, x_noisy, t, cond, return_ids=False):
           
-        if(not self.turbo):
+        if self.residency is not None:
+            self.residency.use(self.model1)
+        elif(not self.turbo):
             self.model1.to(self.cdevice)
 
         step = self.unet_bs
@@ -522,7 +638,9 @@ class UNet(DDPM):
                 hs[j] = torch.cat((hs[j], hs_temp[j]))
         
 
-        if(not self.turbo):
+        if self.residency is not None:
+            self.residency.use(self.model2)
+        elif(not self.turbo):
             self.model1.to("cpu")
             self.model2.to(self.cdevice)
         
@@ -535,7 +653,7 @@ class UNet(DDPM):
             x_recon1 = self.model2(h[i:i+step],emb[i:i+step],x_noisy.dtype,hs_temp,cond[i:i+step])
             x_recon = torch.cat((x_recon, x_recon1))
 
-        if(not self.turbo):
+        if self.residency is None and (not self.turbo):
             self.model2.to("cpu")
 
         if isinstance(x_recon, tuple) and not return_ids:
@@ -594,22 +712,45 @@ class UNet(DDPM):
                log_every_t=100,
                unconditional_guidance_scale=1.,
                unconditional_conditioning=None,
+               cancel=None,
                ):
         
 
-        if(self.turbo):
+        # a residency manager moves the halves on demand in apply_model instead
+        if self.residency is None and self.turbo:
             self.model1.to(self.cdevice)
             self.model2.to(self.cdevice)
 
+        # the sampling loops check the token between steps
+        self.cancel = cancel
+        try:
+            return self.run_sampler(S, conditioning, x0, shape, seed, callback, img_callback, quantize_x0, eta, mask, sampler,
+                                    temperature, noise_dropout, score_corrector, corrector_kwargs, x_T, log_every_t,
+                                    unconditional_guidance_scale, unconditional_conditioning)
+        finally:
+            self.cancel = None
+            if self.residency is None and self.turbo:
+                self.model1.to("cpu")
+                self.model2.to("cpu")
+
+    def check_cancel(self):
+        if self.cancel is not None:
+            self.cancel.check()
+
+    def run_sampler(self, S, conditioning, x0, shape, seed, callback, img_callback, quantize_x0, eta, mask, sampler,
+                    temperature, noise_dropout, score_corrector, corrector_kwargs, x_T, log_every_t,
+                    unconditional_guidance_scale, unconditional_conditioning):
+
         if x0 is None:
             batch_size, b1, b2, b3 = shape
             img_shape = (1, b1, b2, b3)
             tens = []
-            #print("seeds used = ", [seed+s for s in range(batch_size)])
-            for _ in range(batch_size):
-                torch.manual_seed(seed)
+            # a list gives every sample its own seed, otherwise sample n uses seed + n
+            seeds = seed if isinstance(seed, list) else [seed + n for n in range(batch_size)]
+            #print("seeds used = ", seeds)
+            for s in seeds:
+                torch.manual_seed(s)
                 tens.append(torch.randn(img_shape, device=self.cdevice))
-                seed+=1
             noise = torch.cat(tens)
             del tens
 
@@ -637,36 +778,32 @@ class UNet(DDPM):
         elif sampler == "ddim":
             samples = self.ddim_sampling(x_latent, conditioning, S, unconditional_guidance_scale=unconditional_guidance_scale,
                                          unconditional_conditioning=unconditional_conditioning,
-                                         mask = mask,init_latent=x_T,use_original_steps=False)
+                                         mask = mask,init_latent=x_T,use_original_steps=False, callback=callback)
 
         elif sampler == "euler":
             self.make_schedule(ddim_num_steps=S, ddim_eta=eta, verbose=False)
             samples = self.euler_sampling(self.alphas_cumprod,x_latent, S, conditioning, unconditional_conditioning=unconditional_conditioning,
-                                        unconditional_guidance_scale=unconditional_guidance_scale)
+                                        unconditional_guidance_scale=unconditional_guidance_scale, callback=callback)
         elif sampler == "euler_a":
             self.make_schedule(ddim_num_steps=S, ddim_eta=eta, verbose=False)
             samples = self.euler_ancestral_sampling(self.alphas_cumprod,x_latent, S, conditioning, unconditional_conditioning=unconditional_conditioning,
-                                        unconditional_guidance_scale=unconditional_guidance_scale)
+                                        unconditional_guidance_scale=unconditional_guidance_scale, callback=callback)
 
         elif sampler == "dpm2":
             samples = self.dpm_2_sampling(self.alphas_cumprod,x_latent, S, conditioning, unconditional_conditioning=unconditional_conditioning,
-                                        unconditional_guidance_scale=unconditional_guidance_scale)
+                                        unconditional_guidance_scale=unconditional_guidance_scale, callback=callback)
         elif sampler == "heun":
             samples = self.heun_sampling(self.alphas_cumprod,x_latent, S, conditioning, unconditional_conditioning=unconditional_conditioning,
-                                        unconditional_guidance_scale=unconditional_guidance_scale)
+                                        unconditional_guidance_scale=unconditional_guidance_scale, callback=callback)
 
         elif sampler == "dpm2_a":
             samples = self.dpm_2_ancestral_sampling(self.alphas_cumprod,x_latent, S, conditioning, unconditional_conditioning=unconditional_conditioning,
-                                        unconditional_guidance_scale=unconditional_guidance_scale)
+                                        unconditional_guidance_scale=unconditional_guidance_scale, callback=callback)
 
 
         elif sampler == "lms":
             samples = self.lms_sampling(self.alphas_cumprod,x_latent, S, conditioning, unconditional_conditioning=unconditional_conditioning,
-                                        unconditional_guidance_scale=unconditional_guidance_scale)
-
-        if(self.turbo):
-            self.model1.to("cpu")
-            self.model2.to("cpu")
+                                        unconditional_guidance_scale=unconditional_guidance_scale, callback=callback)
 
         return samples
 
@@ -688,6 +825,7 @@ class UNet(DDPM):
         old_eps = []
 
         for i, step in enumerate(iterator):
+            self.check_cancel()
             index = total_steps - i - 1
             ts = torch.full((b,), step, device=device, dtype=torch.long)
             ts_next = torch.full((b,), time_range[min(i + 1, len(time_range) - 1)], device=device, dtype=torch.long)
@@ -708,7 +846,7 @@ class UNet(DDPM):
             old_eps.append(e_t)
             if len(old_eps) >= 4:
                 old_eps.pop(0)
-            if callback: callback(i)
+            if callback: callback({'x': img, 'i': i, 'denoised': pred_x0})
             if img_callback: img_callback(pred_x0, i)
 
         return img
@@ -815,7 +953,7 @@ class UNet(DDPM):
 
     @torch.no_grad()
     def ddim_sampling(self, x_latent, cond, t_start, unconditional_guidance_scale=1.0, unconditional_conditioning=None,
-               mask = None,init_latent=None,use_original_steps=False):
+               mask = None,init_latent=None,use_original_steps=False, callback=None):
 
         timesteps = self.ddim_timesteps
         timesteps = timesteps[:t_start]
@@ -827,6 +965,7 @@ class UNet(DDPM):
         x_dec = x_latent
         x0 = init_latent
         for i, step in enumerate(iterator):
+            self.check_cancel()
             index = total_steps - i - 1
             ts = torch.full((x_latent.shape[0],), step, device=x_latent.device, dtype=torch.long)            
 
@@ -835,9 +974,10 @@ class UNet(DDPM):
                 x0_noisy = x0
                 x_dec = x0_noisy* mask + (1. - mask) * x_dec
 
-            x_dec = self.p_sample_ddim(x_dec, cond, ts, index=index, use_original_steps=use_original_steps,
+            x_dec, pred_x0 = self.p_sample_ddim(x_dec, cond, ts, index=index, use_original_steps=use_original_steps,
                                           unconditional_guidance_scale=unconditional_guidance_scale,
                                           unconditional_conditioning=unconditional_conditioning)
+            if callback: callback({'x': x_dec, 'i': i, 'denoised': pred_x0})
         
         if mask is not None:
             return x0 * mask + (1. - mask) * x_dec
@@ -884,7 +1024,7 @@ class UNet(DDPM):
         if noise_dropout > 0.:
             noise = torch.nn.functional.dropout(noise, p=noise_dropout)
         x_prev = a_prev.sqrt() * pred_x0 + dir_xt + noise
-        return x_prev
+        return x_prev, pred_x0
 
 
     @torch.no_grad()
@@ -897,6 +1037,7 @@ class UNet(DDPM):
 
         s_in = x.new_ones([x.shape[0]]).half()
         for i in clbar(range(len(sigmas) - 1), name = "Images", position = "first", prefixwidth = 12, suffixwidth = 28):
+            self.check_cancel()
             gamma = min(s_churn / (len(sigmas) - 1), 2 ** 0.5 - 1) if s_tmin <= sigmas[i] <= s_tmax else 0.
             eps = torch.randn_like(x) * s_noise
             sigma_hat = (sigmas[i] * (gamma + 1)).half()
@@ -933,6 +1074,7 @@ class UNet(DDPM):
 
         s_in = x.new_ones([x.shape[0]]).half()
         for i in clbar(range(len(sigmas) - 1), name = "Images", position = "first", prefixwidth = 12, suffixwidth = 28):
+            self.check_cancel()
 
             s_i = sigmas[i] * s_in
             x_in = torch.cat([x] * 2)
@@ -967,6 +1109,7 @@ class UNet(DDPM):
 
         s_in = x.new_ones([x.shape[0]]).half()
         for i in clbar(range(len(sigmas) - 1), name = "Images", position = "first", prefixwidth = 12, suffixwidth = 28):
+            self.check_cancel()
             gamma = min(s_churn / (len(sigmas) - 1), 2 ** 0.5 - 1) if s_tmin <= sigmas[i] <= s_tmax else 0.
             eps = torch.randn_like(x) * s_noise
             sigma_hat = (sigmas[i] * (gamma + 1)).half()
@@ -1018,6 +1161,7 @@ class UNet(DDPM):
 
         s_in = x.new_ones([x.shape[0]]).half()
         for i in clbar(range(len(sigmas) - 1), name = "Images", position = "first", prefixwidth = 12, suffixwidth = 28):
+            self.check_cancel()
             gamma = min(s_churn / (len(sigmas) - 1), 2 ** 0.5 - 1) if s_tmin <= sigmas[i] <= s_tmax else 0.
             eps = torch.randn_like(x) * s_noise
             sigma_hat = sigmas[i] * (gamma + 1)
@@ -1033,8 +1177,8 @@ class UNet(DDPM):
             e_t_uncond, e_t = (x_in  + eps * c_out).chunk(2)
             denoised = e_t_uncond + unconditional_guidance_scale * (e_t - e_t_uncond)
 
-
-            
+            if callback is not None:
+                callback({'x': x, 'i': i, 'sigma': sigmas[i], 'sigma_hat': sigma_hat, 'denoised': denoised})
             d = to_d(x, sigma_hat, denoised)
             # Midpoint method, where the midpoint is chosen according to a rho=3 Karras schedule
             sigma_mid = ((sigma_hat ** (1 / 3) + sigmas[i + 1] ** (1 / 3)) / 2) ** 3
@@ -1068,6 +1212,7 @@ class UNet(DDPM):
 
         s_in = x.new_ones([x.shape[0]]).half()
         for i in clbar(range(len(sigmas) - 1), name = "Images", position = "first", prefixwidth = 12, suffixwidth = 28):
+            self.check_cancel()
 
             s_i =  sigmas[i] * s_in
             x_in = torch.cat([x] * 2)
@@ -1116,6 +1261,7 @@ class UNet(DDPM):
 
         ds = []
         for i in clbar(range(len(sigmas) - 1), name = "Images", position = "first", prefixwidth = 12, suffixwidth = 28):
+            self.check_cancel()
 
             s_i =  sigmas[i] * s_in
             x_in = torch.cat([x] * 2)
@@ -0,0 +1,1695 @@
+# Import core libraries
+import os, re, time, sys, asyncio, ctypes, math, struct
+import torch
+import numpy as np
+from random import randint
+from omegaconf import OmegaConf
+from PIL import Image
+from itertools import islice, chain
+from collections import OrderedDict
+from einops import rearrange, repeat
+from pytorch_lightning import seed_everything
+from contextlib import nullcontext
+from functools import partial
+from typing import Optional
+
+# Import built libraries
+from ldm.util import instantiate_from_config, init_missing
+from optimUtils import split_weighted_subprompts
+from pixelvae import load_pixelvae_model
+from postprocess import kCentroid, kDenoise, strip_palette, quantize_distortions, palettize_frame, sample_frames, detect_grid, grid_downscale, DIFFUSION_KERNELS
+import postprocess_torch
+from jobqueue import Job, JobQueue, batchable, cancelled_jobs
+from checkpoint import find_split, load_split, load_checkpoint, cast_state_dict, split_unet_keys, assign_state_dict, run_load_hooks
+# Imported through the same module path as the config targets, so the conditioning cache is shared
+from scripts.ddpm import CondStage, Cancelled, CancelToken, CancelGroup
+
+# Import PyTorch functions
+from torch import autocast
+from torch import Tensor
+from torch.nn import functional as F
+from torch.nn.modules.utils import _pair
+
+# Import logging libraries
+import traceback, warnings
+import logging as pylog
+from transformers import logging
+
+# Import websocket tools
+import requests
+from websockets import serve, connect
+from websockets.exceptions import ConnectionClosed
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import multiprocessing
+from io import BytesIO
+
+# Import post-processing libraries
+from rembg import remove, new_session
+
+# Import console management libraries
+import pygetwindow as gw
+from rich import print as rprint
+from colorama import just_fix_windows_console
+
+# Fix windows console for color codes
+just_fix_windows_console()
+
+# Patch existing console to remove interactivity
+kernel32 = ctypes.windll.kernel32
+kernel32.SetConsoleMode(kernel32.GetStdHandle(-10), 128)
+
+log = pylog.getLogger("pytorch_lightning")
+log.propagate = False
+log.setLevel(pylog.ERROR)
+logging.set_verbosity_error()
+
+global model
+global modelCS
+global modelFS
+global running
+
+global timeout
+global loaded
+loaded = ""
+
+# Share of the device memory loaded models may keep resident between uses, the rest is left for sampling
+residency_budget = 0.5
+residency = None
+
+# Loaded models are kept in host memory up to this many bytes, so switching back to one skips the reload
+model_cache_budget = 8 * 1024**3
+model_cache = OrderedDict()
+
+# Images sampled and decoded in one pass in turbo mode, chunks are halved while the device runs out of memory
+micro_batch = 4
+
+# All model and post-processing work runs on this single thread so the websocket loop stays responsive
+inference = ThreadPoolExecutor(max_workers=1, thread_name_prefix="inference")
+current = None
+
+# Worker processes palettizing the frames of animations in parallel, and the frames submitted to them but not collected yet
+palettizer = None
+palettizing = []
+# At most this many worker processes, each one holds its own copy of numpy, PIL and the frames it works on
+palettize_workers = 4
+# Animations with fewer pixels than this are palettized on the inference thread, sending them to the workers costs more than it saves
+palettize_parallel_pixels = 512 * 512
+
+# Values the per-connection settings accept
+transports = ("file", "png", "rgba")
+colorspaces = ("rgb", "oklab")
+backends = ("numpy", "torch")
+
+# Background removal model, loaded on first use and kept for later requests
+rembg_session = None
+# Frames run through the background removal model at once
+rembg_batch = 8
+
+def patch_conv(**patch):
+    # Patch the Conv2d class with a custom __init__ method
+    cls = torch.nn.Conv2d
+    init = cls.__init__
+
+    def __init__(self, *args, **kwargs):
+        # Call the original init method and apply the patch arguments
+        return init(self, *args, **kwargs, **patch)
+    
+    cls.__init__ = __init__
+
+def patch_conv_asymmetric(model, x, y):
+    # Patch Conv2d layers in the given model for asymmetric padding
+    for layer in flatten(model):
+        if type(layer) == torch.nn.Conv2d:
+            # Set padding mode based on x and y arguments
+            layer.padding_modeX = 'circular' if x else 'constant'
+            layer.padding_modeY = 'circular' if y else 'constant'
+
+            # Compute padding values based on reversed padding repeated twice
+            layer.paddingX = (layer._reversed_padding_repeated_twice[0], layer._reversed_padding_repeated_twice[1], 0, 0)
+            layer.paddingY = (0, 0, layer._reversed_padding_repeated_twice[2], layer._reversed_padding_repeated_twice[3])
+
+            # Patch the _conv_forward method with a replacement function
+            layer._conv_forward = __replacementConv2DConvForward.__get__(layer, torch.nn.Conv2d)
+
+def restoreConv2DMethods(model):
+        # Restore original _conv_forward method for Conv2d layers in the model
+        for layer in flatten(model):
+            if type(layer) == torch.nn.Conv2d:
+                layer._conv_forward = torch.nn.Conv2d._conv_forward.__get__(layer, torch.nn.Conv2d)
+
+def __replacementConv2DConvForward(self, input: Tensor, weight: Tensor, bias: Optional[Tensor]):
+    # Replacement function for Conv2d's _conv_forward method
+    working = F.pad(input, self.paddingX, mode=self.padding_modeX)
+    working = F.pad(working, self.paddingY, mode=self.padding_modeY)
+    return F.conv2d(working, weight, bias, self.stride, _pair(0), self.dilation, self.groups)
+
+def patch_tiling(tilingX, tilingY, model, modelFS):
+    # Convert tilingX and tilingY to boolean values
+    X = bool(tilingX == "true")
+    Y = bool(tilingY == "true")
+
+    # Patch Conv2d layers in the given models for asymmetric padding
+    patch_conv_asymmetric(model, X, Y)
+    patch_conv_asymmetric(modelFS, X, Y)
+
+    if X or Y:
+        # Print a message indicating the direction(s) patched for tiling
+        rprint("[#494b9b]Patched for tiling in the [#48a971]" + "X" * X + "[#494b9b] and [#48a971]" * (X and Y) + "Y" * Y + "[#494b9b] direction" + "s" * (X and Y))
+
+    return model, modelFS
+
+def chunk(it, size):
+    # Create an iterator from the input iterable
+    it = iter(it)
+
+    # Return an iterator that yields tuples of the specified size
+    return iter(lambda: tuple(islice(it, size)), ())
+
+def searchString(string, *args):
+    out = []
+
+    # Iterate over the range of arguments, excluding the last one
+    for x in range(len(args)-1):
+        # Perform a regex search in the string using the current and next argument as lookaround patterns
+        # Append the matched substring to the output list
+        out.append(re.search(f"(?<={{{args[x]}}}).*(?={{{args[x+1]}}})", string).group())
+
+    return out
+
+def climage(file, alignment, *args):
+
+    # Get console bounds with a small margin - better safe than sorry
+    twidth, theight = os.get_terminal_size().columns-1, (os.get_terminal_size().lines-1)*2
+
+    # Set up variables
+    image = Image.open(file)
+    image = image.convert('RGBA')
+    iwidth, iheight = min(twidth, image.width), min(theight, image.height)
+    line = []
+    lines = []
+
+    # Alignment stuff
+
+    margin = 0
+    if alignment == "centered":
+        margin = int((twidth/2)-(iwidth/2))
+    elif alignment == "right":
+        margin = int(twidth-iwidth)
+    elif alignment == "manual":
+        margin = args[0]
+    
+    # Loop over the height of the image / 2 (because 2 pixels = 1 text character)
+    for y2 in range(int(iheight/2)):
+
+        # Add default colors to the start of the line
+        line = ["[white on black]" + " "*margin]
+        rgbp, rgb2p = "", ""
+
+        # Loop over width
+        for x in range(iwidth):
+
+            # Get the color for the upper and lower half of the text character
+            r, g, b, a = image.getpixel((x, (y2*2)))
+            r2, g2, b2, a2 = image.getpixel((x, (y2*2)+1))
+
+            # Convert to hex colors for Rich to use
+            rgb, rgb2 = '#{:02x}{:02x}{:02x}'.format(r, g, b), '#{:02x}{:02x}{:02x}'.format(r2, g2, b2)
+
+            # Lookup table because I was bored
+            colorCodes = [f"[{rgb2} on {rgb}]", f"[{rgb2} on black]", f"[black on {rgb}]", "[white on black]", f"[{rgb}]"]
+            # ~It just works~
+            color = colorCodes[int(a < 200)+(int(a2 < 200)*2)+(int(rgb == rgb2 and a + a2 > 400)*4)]
+
+            # Don't change the color if the color doesn't change...
+            if rgb == rgbp and rgb2 == rgb2p:
+                color = ""
+            
+            # Set text characters, nothing, full block, half block. Half block + background color = 2 pixels
+            if a < 200 and a2 < 200:
+                line.append(color + " ")
+            elif rgb == rgb2:
+                line.append(color + "█")
+            else:
+                line.append(color + "▄")
+
+            rgbp, rgb2p = rgb, rgb2
+        
+        # Add default colors to the end of the line
+        lines.append("".join(line) + "[white on black]")
+    return "\n".join(lines)
+
+def clbar(iterable, name = "", printEnd = "\r", position = "", unit = "it", disable = False, prefixwidth = 1, suffixwidth = 1, total = 0):
+
+    # Console manipulation stuff
+    def up(lines = 1):
+        for _ in range(lines):
+            sys.stdout.write('\x1b[1A')
+            sys.stdout.flush()
+
+    def down(lines = 1):
+        for _ in range(lines):
+            sys.stdout.write('\n')
+            sys.stdout.flush()
+
+    # Allow the complete disabling of the progress bar
+    if not disable:
+        # Positions the bar correctly
+        down(int(position == "last")*2)
+        up(int(position == "first")*3)
+        
+        # Set up variables
+        if total > 0:
+            iterable = iterable[0:total]
+        else:
+            total = max(1, len(iterable))
+        name = f"{name}"
+        speed = f" {total}/{total} at 100.00 {unit}/s "
+        prediction = f" 00:00 < 00:00 "
+        prefix = max(len(name), len("100%"), prefixwidth)
+        suffix = max(len(speed), len(prediction), suffixwidth)
+        barwidth = os.get_terminal_size().columns-(suffix+prefix+2)
+
+        # Prints the progress bar
+        def printProgressBar (iteration, delay):
+
+            # Define progress bar graphic
+            line1 = ["[#494b9b on #3b1725]▄", 
+                    "[#c4f129 on #494b9b]▄" * int(int(barwidth * iteration // total) > 0), 
+                    "[#ffffff on #494b9b]▄" * max(0, int(barwidth * iteration // total)-2),
+                    "[#c4f129 on #494b9b]▄" * int(int(barwidth * iteration // total) > 1),
+                    "[#3b1725 on #494b9b]▄" * max(0, barwidth-int(barwidth * iteration // total)),
+                    "[#494b9b on #3b1725]▄[white on black]"]
+            line2 = ["[#3b1725 on #494b9b]▄", 
+                    "[#494b9b on #48a971]▄" * int(int(barwidth * iteration // total) > 0), 
+                    "[#494b9b on #c4f129]▄" * max(0, int(barwidth * iteration // total)-2),
+                    "[#494b9b on #48a971]▄" * int(int(barwidth * iteration // total) > 1),
+                    "[#494b9b on #3b1725]▄" * max(0, barwidth-int(barwidth * iteration // total)),
+                    "[#3b1725 on #494b9b]▄[white on black]"]
+
+            percent = ("{0:.0f}").format(100 * (iteration / float(total)))
+
+            # Avoid predicting speed until there's enough data
+            if len(delay) >= 1:
+                delay.append(time.time()-delay[-1])
+                del delay [-2]
+
+            # Fancy color stuff and formating
+            if iteration == 0:
+                speedColor = "[#48a971 on black]"
+                measure = f"... {unit}/s"
+                passed = f"00:00"
+                remaining = f"??:??"
+            else:
+                if np.mean(delay) <= 1:
+                    measure = f"{round(1/max(0.01, np.mean(delay)), 2)} {unit}/s"
+                else:
+                    measure = f"{round(np.mean(delay), 2)} s/{unit}"
+
+                if np.mean(delay) <= 1:
+                    speedColor = "[#c4f129 on black]"
+                elif np.mean(delay) <= 10:
+                    speedColor = "[#48a971 on black]"
+                elif np.mean(delay) <= 30:
+                    speedColor = "[#494b9b on black]"
+                else:
+                    speedColor = "[#ab333d on black]"
+
+                passed = "{:02d}:{:02d}".format(math.floor(sum(delay)/60), round(sum(delay))%60)
+                remaining = "{:02d}:{:02d}".format(math.floor((total*np.mean(delay)-sum(delay))/60), round(total*np.mean(delay)-sum(delay))%60)
+
+            speed = f" {iteration}/{total} at {measure} "
+            prediction = f" {passed} < {remaining} "
+
+            # Print single bar across two lines
+            rprint(f'\r{f"{name}".center(prefix)} {"".join(line1)}{speedColor}{speed.center(suffix-1)}[white on black]')
+            rprint(f'[#48a971 on black]{f"{percent}%".center(prefix)}[white on black] {"".join(line2)}[#494b9b on black]{prediction.center(suffix-1)}', end = printEnd)
+            delay.append(time.time())
+
+            return delay
+
+        # Print at 0 progress
+        delay = []
+        delay = printProgressBar(0, delay)
+        down(int(position == "first")*2)
+        # Update the progress bar
+        for i, item in enumerate(iterable):
+            yield item
+            up(int(position == "first")*2+1)
+            delay = printProgressBar(i + 1, delay)
+            down(int(position == "first")*2)
+            
+        down(int(position != "first"))
+    else:
+        for i, item in enumerate(iterable):
+            yield item
+
+def load_model_from_config(model, verbose=False):
+    # Load the model's state dictionary from the specified file
+    return load_checkpoint(model)
+
+def load_img(path, h0, w0):
+    # Open the image at the specified path (or take an in-memory image) and prepare it for image to image
+    if isinstance(path, Image.Image):
+        image = path.convert("RGB")
+    else:
+        image = Image.open(path).convert("RGB")
+    w, h = image.size
+
+    # Override the image size if h0 and w0 are provided
+    if h0 is not None and w0 is not None:
+        h, w = h0, w0
+
+    # Adjust the width and height to be divisible by 8 and resize the image using bicubic resampling
+    w, h = map(lambda x: x - x % 8, (w, h))
+    image = image.resize((w, h), resample=Image.Resampling.BICUBIC)
+
+    # Convert the image to a numpy array of float32 values in the range [0, 1], transpose it, and convert it to a PyTorch tensor
+    image = np.array(image).astype(np.float32) / 255.0
+    image = image[None].transpose(0, 3, 1, 2)
+    image = torch.from_numpy(image)
+
+    # Apply a normalization by scaling the values in the range [-1, 1]
+    return 2.*image - 1.
+
+def flatten(el):
+    # Flatten nested elements by recursively traversing through children
+    flattened = [flatten(children) for children in el.children()]
+    res = [el]
+    for c in flattened:
+        res += c
+    return res
+
+# Coefficients projecting the four latent channels to RGB, a rough but nearly free stand-in for the first stage decoder
+latent_rgb = [
+    [0.298, 0.207, 0.208],
+    [0.187, 0.286, 0.173],
+    [-0.158, 0.189, 0.264],
+    [-0.184, -0.271, -0.473],
+]
+
+def latent_to_rgb(samples):
+    # Apply the color transformation to the samples and normalize the values to [0, 1]
+    coefs = torch.tensor(latent_rgb, device=samples.device, dtype=samples.dtype)
+    x_samples = torch.einsum("blxy,lr -> brxy", samples, coefs)
+    x_samples = torch.clamp((x_samples + 1.0) / 2.0, min=0.0, max=1.0)
+
+    # Rearrange the dimensions of the tensor and scale the values to the range [0, 255]
+    return 255. * np.moveaxis(x_samples.float().cpu().numpy(), 1, 3)
+
+def check_cancel(cancel):
+    # Stop a job between units of work once its client cancelled it
+    if cancel is not None:
+        cancel.check()
+
+def module_size(module):
+    # Bytes held by the parameters and buffers of a model
+    return sum(t.element_size() * t.nelement() for t in chain(module.parameters(), module.buffers()))
+
+class Residency:
+    # Decides which models live on the inference device, moving the least recently used ones back to the CPU only when the memory budget requires it
+    def __init__(self, device, budget):
+        self.device = device
+        self.budget = budget
+        self.sizes = {}
+        self.resident = OrderedDict()
+
+    def size(self, module):
+        # Bytes of parameters and buffers, measured once per model
+        if id(module) not in self.sizes:
+            self.sizes[id(module)] = module_size(module)
+        return self.sizes[id(module)]
+
+    def release(self):
+        # Move every resident model back to the CPU, used when another model takes over the device
+        for module in self.resident.values():
+            module.to("cpu")
+        self.resident.clear()
+
+    def use(self, *modules):
+        # Everything already lives in host memory on CPU-only hosts
+        if self.device == "cpu":
+            return
+
+        needed = [module for module in modules if id(module) not in self.resident]
+        if needed:
+            # Evict least recently used models that are not requested until the new ones fit the budget
+            requested = set(id(module) for module in modules)
+            used = sum(self.size(module) for module in self.resident.values())
+            required = sum(self.size(module) for module in needed)
+            for key in list(self.resident):
+                if used + required <= self.budget:
+                    break
+                if key not in requested:
+                    evicted = self.resident.pop(key)
+                    evicted.to("cpu")
+                    used -= self.size(evicted)
+
+            for module in needed:
+                module.to(self.device)
+                self.resident[id(module)] = module
+
+            # Wait on an event for the copies to finish instead of polling the allocator
+            event = torch.cuda.Event()
+            event.record()
+            event.synchronize()
+
+        for module in modules:
+            self.resident.move_to_end(id(module))
+
+def load_model(modelpath, modelfile, config, device, precision, optimized):
+    timer = time.time()
+
+    # Check the modelfile and print corresponding loading message
+    print()
+    if modelfile == "v1-5.ckpt":
+        print(f"Loading base model (SD-1.5)")
+    elif modelfile == "model.pxlm":
+        print(f"Loading pixel model")
+    elif modelfile == "modelmini.pxlm":
+        print(f"Loading mini pixel model")
+    elif modelfile == "modelmega.pxlm":
+        print(f"Loading mega pixel model")
+    elif modelfile == "modelRPG.pxlm":
+        print(f"Loading game item pixel model")
+    elif modelfile == "modelRPGmini.pxlm":
+        print(f"Loading mini game item pixel model")
+    elif modelfile == "paletteGen.pxlm":
+        print(f"Loading PaletteGen model")
+    else:
+        rprint(f"Loading custom model from [#48a971]{modelfile}")
+
+    global model
+    global modelCS
+    global modelFS
+    global residency
+
+    # Get the current model off the device before the next one needs it
+    if residency is not None:
+        residency.release()
+
+    # Switch to a model kept in host memory from an earlier load if possible
+    key = (modelpath + modelfile, device, precision, optimized)
+    if key in model_cache:
+        model_cache.move_to_end(key)
+        model, modelCS, modelFS, residency, precision, _ = model_cache[key]
+        rprint(f"[#c4f129]Loaded cached model to [#48a971]{model.cdevice}[#c4f129] at [#48a971]{precision} precision[#c4f129] in [#48a971]{round(time.time()-timer, 2)} [#c4f129]seconds")
+        return
+
+    # Determine if turbo mode is enabled
+    turbo = True
+    if optimized == "true":
+        turbo = False
+
+    # Load the weights at the precision they will run at, the first stage always runs at full precision
+    dtype = torch.float16 if device != "cpu" and precision == "autocast" else torch.float32
+    dtypes = {"model1": dtype, "model2": dtype, "cond_stage_model": dtype, "first_stage_model": torch.float32, "common": torch.float32}
+
+    # Prefer the pre-split, memory-mapped copy of the checkpoint if one was converted at the precision needed
+    split = find_split(modelpath + modelfile, dtype)
+    if split is not None:
+        groups = load_split(split, dtypes)
+        sdUNet = {**groups["common"], **groups["model1"], **groups["model2"]}
+        sdCS = {**groups["common"], **groups["cond_stage_model"]}
+        sdFS = {**groups["common"], **groups["first_stage_model"]}
+    else:
+        # Load the model's state dictionary from the specified file
+        sd = load_model_from_config(f"{modelpath+modelfile}")
+
+        # Reorganize the state dictionary keys to match the split UNet structure and cast tensor by tensor
+        sdUNet = sdCS = sdFS = cast_state_dict(split_unet_keys(sd), dtypes)
+
+    def load_weights(module, sd):
+        # The checkpoint tensors already have the final dtype and become the module weights without another copy
+        assign_state_dict(module, sd)
+
+        # The models are built without initializing their weights, initialize whatever the checkpoint left out
+        missing = [key for key in module.state_dict() if key not in sd]
+        init_missing(module, missing)
+
+        # Tensors derived from loaded ones are set by the same hooks load_state_dict runs
+        run_load_hooks(module, missing)
+
+    # Load the model configuration
+    config = OmegaConf.load(f"{config}")
+
+    # Instantiate and load the main model
+    model = instantiate_from_config(config.modelUNet, empty=True)
+    load_weights(model, sdUNet)
+    model.eval()
+    model.unet_bs = 1
+    model.cdevice = device
+    model.turbo = turbo
+
+    # Instantiate and load the conditional stage model
+    modelCS = instantiate_from_config(config.modelCondStage, empty=True)
+    load_weights(modelCS, sdCS)
+    modelCS.eval()
+    modelCS.cond_stage_model.device = device
+
+    # Instantiate and load the first stage model
+    modelFS = instantiate_from_config(config.modelFirstStage, empty=True)
+    load_weights(modelFS, sdFS)
+    modelFS.eval()
+
+    # Set precision and device settings
+    if device != "cpu" and precision == "autocast":
+        model.half()
+        modelCS.half()
+        precision = "half"
+
+    # Let the residency manager place the models, optimized mode only keeps the model in use on the device
+    if device != "cpu":
+        budget = 0 if optimized == "true" else int(torch.cuda.get_device_properties(device).total_memory * residency_budget)
+    else:
+        budget = 0
+    residency = Residency(device, budget)
+    model.residency = residency
+
+    # Keep the model in host memory for later switches, dropping the least recently used ones over budget
+    model_cache[key] = (model, modelCS, modelFS, residency, precision, sum(module_size(m) for m in (model, modelCS, modelFS)))
+    while len(model_cache) > 1 and sum(entry[-1] for entry in model_cache.values()) > model_cache_budget:
+        model_cache.popitem(last=False)
+    
+    # Print loading information
+    rprint(f"[#c4f129]Loaded model to [#48a971]{model.cdevice}[#c4f129] at [#48a971]{precision} precision[#c4f129] in [#48a971]{round(time.time()-timer, 2)} [#c4f129]seconds")
+
+def pixelDetectVerbose(images=None, backend="numpy"):
+    # Use the in-memory input image if provided, otherwise check if input file exists and open it
+    if images is None:
+        assert os.path.isfile("temp/input.png")
+        init_img = Image.open("temp/input.png")
+    else:
+        init_img = images[0]
+
+    rprint(f"\n[#48a971]Finding pixel ratio for current cel")
+
+    # Find the pixel grid from the lattice the color edges between neighbouring pixels lie on, separately for both axes
+    # so uneven ratios and grids not starting at the image corner are kept, and downscale to one pixel per grid cell
+    for _ in clbar(range(1), name = "Processed", position = "last", unit = "image", prefixwidth = 12, suffixwidth = 28):
+        x, y, confidence = detect_grid(init_img)
+        if backend == "torch":
+            downscale = postprocess_torch.to_image(postprocess_torch.grid_downscale(postprocess_torch.to_tensor(init_img, tensor_device()), x, y))
+        else:
+            downscale = grid_downscale(init_img, x, y)
+
+        numColors = determine_best_k_verbose(downscale, 64, 10)
+
+        for _ in clbar([downscale], name = "Palettizing", position = "first", prefixwidth = 12, suffixwidth = 28): 
+            img_indexed = downscale.quantize(colors=numColors, method=1, kmeans=numColors, dither=0).convert('RGB')
+        
+        if images is None:
+            img_indexed.save("temp/temp.png")
+    rprint(f"[#c4f129]Found a [#48a971]{round(x[0], 2)}x{round(y[0], 2)}[#c4f129] pixel grid with [#48a971]{round(confidence*100)}%[#c4f129] confidence")
+    return [img_indexed]
+
+def determine_best_k_verbose(image, max_k, accuracy):
+    # Do some math on threshold
+    # Unused
+    threshold = 0.5/(accuracy**3)
+
+    # Calculate distortion for different values of k
+    # Divided into 'chunks' for nice progress displaying
+    chunks = range(4, round(max_k/8) + 2)
+    quantized = quantize_distortions(image, sum(round(max_k/k) for k in chunks))
+    distortions = []
+    for k in clbar(chunks, name = "Finding K", position = "first", prefixwidth = 12, suffixwidth = 28):
+        for n in range(round(max_k/k)):
+            distortions.append(next(quantized))
+
+
+    # Remap distortions to the range of 0-1
+    # Unused
+    """
+    distortion_min = np.min(distortions)
+    distortion_max = np.max(distortions)
+    distortions = 10 * (distortions - distortion_min) / (distortion_max - distortion_min)
+    """
+
+    # Calculate the rate of change of distortions
+    rate_of_change = np.diff(distortions) / np.array(distortions[:-1])
+    
+    # Find the elbow point (best k value)
+    if len(rate_of_change) == 0:
+        best_k = 1
+    else:
+        elbow_index = np.argmax(rate_of_change) + 1
+        best_k = elbow_index + 2
+
+    # Unused accuracy slider
+    """
+    # Interactive, decided it defeated the purpose of doing it "automatically"
+    
+    best_k = 1
+    for i in range(1, len(rate_of_change)):
+        diff = np.abs(distortions[i] - distortions[i-1])
+        if diff <= threshold:
+            best_k = i + 1  # Elbow point found
+            break
+    if best_k == 1:
+        elbow_index = np.argmax(rate_of_change) + 1
+        best_k = elbow_index + 1
+    """
+
+    return best_k
+
+def palettize(numFiles, source, colors, accuracy, paletteFile, paletteURL, dithering, strength, denoise, smoothness, intensity, images=None, cancel=None, space="rgb", backend="numpy"):
+    # Check if a palette URL is provided and try to download the palette image
+    if source == "URL":
+        try:
+            paletteFile = BytesIO(requests.get(paletteURL).content)
+            testImg = Image.open(paletteFile).convert('RGB')
+        except:
+            rprint(f"\n[#ab333d]ERROR: URL {paletteURL} cannot be reached or is not an image\nReverting to Adaptive palette")
+            paletteFile = ""
+
+    timer = time.time()
+
+    # Create a list to store file paths, in-memory images replace the files entirely
+    files = []
+    if images is None:
+        for n in range(numFiles):
+            files.append(f"temp/input{n+1}.png")
+        images = [Image.open(file) for file in files]
+
+    # Determine the number of colors based on the palette or user input
+    # The palette is read once for all images
+    if paletteFile != "":
+        palImg = Image.open(paletteFile).convert('RGB')
+        palColors = [color for _, color in palImg.getcolors(16777216)]
+        numColors = len(palColors)
+    else:
+        numColors = colors
+
+    # Create the string for conversion message
+    string = f"\n[#48a971]Converting output[white] to [#48a971]{numColors}[white] colors"
+
+    # Dithering is either the order of a Bayer matrix or the name of an error diffusion kernel
+    diffuse = dithering in DIFFUSION_KERNELS
+    dither = strength > 0 and (diffuse or dithering > 0)
+
+    # Add dithering information if strength and dithering are greater than 0
+    if dither and diffuse:
+        string = f'{string} with [#48a971]{dithering}[white] dithering'
+    elif dither:
+        string = f'{string} with order [#48a971]{dithering}[white] dithering'
+
+    if source == "Automatic":
+        string = f"\n[#48a971]Converting output[white] to best color palette"
+    elif source == "Perceptual" and paletteFile == "":
+        string = string.replace(" colors", " perceptual colors", 1)
+
+    # Print the conversion message
+    rprint(string)
+
+    # Automatic palettes pick their number of colors once for all images
+    palette = palColors if paletteFile != "" else None
+    numColors = None if source == "Automatic" and palette is None else numColors
+
+    # Perceptual palettes are picked by k-means in OKLab instead of PIL's quantizer
+    quantizer = "oklab" if source == "Perceptual" else "pil"
+
+    # Frames of large enough animations are spread over the palettize worker processes
+    pool = None
+    if len(images) > 1 and os.cpu_count() > 1 and backend != "torch" and sum(img.width * img.height for img in images) >= palettize_parallel_pixels:
+        pool = palettize_pool()
+
+    # Denoise first, the number of colors is picked from the denoised frames
+    if backend == "torch":
+        # Frames go through the tensor versions one after another, each operation already uses the whole device
+        frames = [postprocess_torch.to_tensor(img, tensor_device()) for img in images]
+        if denoise == "true":
+            frames = [postprocess_torch.kDenoise(frame, smoothness, intensity) for frame in frames]
+    else:
+        frames = [img.convert('RGB') for img in images]
+        if denoise == "true":
+            frames = map_frames(pool, cancel, "Denoised", kDenoise, frames, smoothness, intensity)
+
+    # The frames of an animation share one number of colors, picked from pixels spread over all of them
+    if numColors is None:
+        numColors = determine_best_k_verbose(sample_frames([postprocess_torch.to_image(frame) for frame in frames] if backend == "torch" else frames), 64, accuracy)
+
+    if backend == "torch":
+        outputs = []
+        for frame in clbar(frames, name = "Processed", position = "last", unit = "image", prefixwidth = 12, suffixwidth = 28):
+            check_cancel(cancel)
+            outputs.append(postprocess_torch.to_image(postprocess_torch.palettize_frame(frame, palette, numColors, dithering, strength, "false", smoothness, intensity, space, quantizer)))
+    else:
+        outputs = map_frames(pool, cancel, "Processed", palettize_frame, frames, palette, numColors, dithering, strength, "false", smoothness, intensity, space, quantizer)
+
+    # Overwrite the input files, or keep the results in memory for the client
+    for file, img_indexed in zip(files, outputs):
+        img_indexed.save(file)
+    rprint(f"[#c4f129]Palettized [#48a971]{len(outputs)}[#c4f129] images in [#48a971]{round(time.time()-timer, 2)}[#c4f129] seconds")
+    return outputs
+
+def palettize_pool():
+    global palettizer
+    # Started on first use and kept, its processes only import the image_server.py launcher and postprocess
+    if palettizer is None:
+        palettizer = ProcessPoolExecutor(max_workers=min(palettize_workers, os.cpu_count()), mp_context=multiprocessing.get_context("spawn"))
+    return palettizer
+
+def map_frames(pool, cancel, name, function, frames, *args):
+    # Run function on every frame and collect the results in order, on the worker processes of pool if there is one
+    if pool is None:
+        results = []
+        for frame in clbar(frames, name = name, position = "last", unit = "image", prefixwidth = 12, suffixwidth = 28):
+            check_cancel(cancel)
+            results.append(function(frame, *args))
+        return results
+
+    futures = [pool.submit(function, frame, *args) for frame in frames]
+    palettizing.extend(futures)
+    try:
+        results = []
+        for future in clbar(futures, name = name, position = "last", unit = "image", prefixwidth = 12, suffixwidth = 28):
+            check_cancel(cancel)
+            results.append(future.result())
+        return results
+    finally:
+        # Frames not started yet are dropped when cancelled
+        for future in futures:
+            future.cancel()
+            palettizing.remove(future)
+
+def tensor_device():
+    # Tensor post-processing runs on the GPU when there is one and on the CPU torch threads otherwise
+    return torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+def rembg(numFiles, images=None):
+    
+    timer = time.time()
+    files = []
+
+    # Create a list of file paths, in-memory images replace the files entirely
+    if images is None:
+        for n in range(numFiles):
+            files.append(f"temp/input{n+1}.png")
+        images = [Image.open(file) for file in files]
+
+    rprint(f"\n[#48a971]Removing [#48a971]{len(images)}[white] backgrounds")
+
+    # Process the images in batches
+    outputs = []
+    batches = [images[i:i + rembg_batch] for i in range(0, len(images), rembg_batch)]
+    for batch in clbar(batches, name = "Processed", position = "", unit = "batch", prefixwidth = 12, suffixwidth = 28):
+        batch = [img.convert('RGB') for img in batch]
+
+        # Ignore warnings during background removal
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+
+            # Remove the backgrounds and save the images
+            for img in remove_backgrounds(batch):
+                if files:
+                    img.save(files[len(outputs)])
+                outputs.append(img)
+    rprint(f"[#c4f129]Removed [#48a971]{len(outputs)}[#c4f129] backgrounds in [#48a971]{round(time.time()-timer, 2)}[#c4f129] seconds")
+    return outputs
+
+def remove_backgrounds(images):
+    global rembg_session
+    # Loading the segmentation model dominates a single removal, so the session is kept
+    if rembg_session is None:
+        rembg_session = new_session("u2net")
+    session = rembg_session
+
+    # Models with a fixed batch size take one frame at a time, ONNX marks a dynamic dimension with a name or None
+    model_input = session.inner_session.get_inputs()[0]
+    if isinstance(model_input.shape[0], int) or len(images) == 1:
+        return [remove(img, session=session) for img in images]
+
+    # Run all frames through the model at once, the same way rembg's u2net session runs a single one
+    inputs = [session.normalize(img, (0.485, 0.456, 0.406), (0.229, 0.224, 0.225), (320, 320))[model_input.name] for img in images]
+    predictions = session.inner_session.run(None, {model_input.name: np.concatenate(inputs)})[0][:, 0]
+
+    outputs = []
+    for img, prediction in zip(images, predictions):
+        # Stretch the prediction to a full range mask and cut the image out with it
+        prediction = (prediction - prediction.min()) / (prediction.max() - prediction.min())
+        mask = Image.fromarray((prediction * 255).astype("uint8"), mode="L").resize(img.size, Image.LANCZOS)
+        outputs.append(Image.composite(img, Image.new("RGBA", img.size, 0), mask))
+    return outputs
+
+def kCentroidVerbose(width, height, centroids, images=None, backend="numpy"):
+    # Use the in-memory input image if provided, otherwise check if the input file exists and open it
+    if images is None:
+        assert os.path.isfile("temp/input.png")
+        init_img = Image.open("temp/input.png")
+    else:
+        init_img = images[0]
+
+    rprint(f"\n[#48a971]K-Centroid downscaling[white] from [#48a971]{init_img.width}[white]x[#48a971]{init_img.height}[white] to [#48a971]{width}[white]x[#48a971]{height}[white] with [#48a971]{centroids}[white] centroids")
+
+    # Perform k-centroid downscaling and save the image
+    for _ in clbar(range(1), name = "Processed", unit = "image", prefixwidth = 12, suffixwidth = 28):
+        if backend == "torch":
+            pixels = postprocess_torch.to_tensor(init_img, tensor_device())
+            downscale = postprocess_torch.to_image(postprocess_torch.kCentroid(pixels, int(width), int(height), int(centroids)))
+        else:
+            downscale = kCentroid(init_img, int(width), int(height), int(centroids))
+        if images is None:
+            downscale.save("temp/temp.png")
+    return [downscale]
+        
+def paletteGen(colors, device, precision, prompt, seed, save=True, cancel=None):
+    # Calculate the base for palette generation
+    base = 2**round(math.log2(colors))
+
+    # Every color is drawn as a vertical strip 512/base pixels wide
+    width = 512+((512/base)*(colors-base))
+
+    # Generate text-to-image conversion with specified parameters, keeping the result in memory
+    image = txt2img("false", device, precision, prompt, "", int(width), 512, 20, 7.0, int(seed), 1, "false", "false", save=False, cancel=cancel)[0]
+
+    # Reduce every strip to its most common color, written straight into a paletted image
+    palette = strip_palette(image, 512/base, colors)
+
+    if save:
+        palette.save("temp/temp.png")
+    rprint(f"[#c4f129]Image converted to color palette with [#48a971]{colors}[#c4f129] colors")
+    return [palette]
+
+class Prompt:
+    # One request's share of a txt2img batch
+    def __init__(self, prompt, negative, scale, seed, n_iter, cancel=None, preview=None):
+        self.prompt = prompt
+        self.negative = negative
+        self.scale = scale
+        self.seed = seed
+        self.n_iter = n_iter
+        self.cancel = cancel
+        self.preview = preview
+
+def out_of_memory(error):
+    # Allocation failures of the device, older torch versions raise a plain RuntimeError for them
+    return isinstance(error, torch.cuda.OutOfMemoryError) or "out of memory" in str(error)
+
+def micro_batches(run, images):
+    # Call run with the number of images to process per pass, starting at micro_batch
+    # When the device runs out of memory the whole call is repeated with half as many, down to one image per pass
+    size = max(1, min(micro_batch, images))
+    while True:
+        try:
+            return run(size)
+        except RuntimeError as error:
+            if size == 1 or not out_of_memory(error):
+                raise
+            size = size // 2
+            torch.cuda.empty_cache()
+            rprint(f"[#ab333d]Out of memory, retrying with [#48a971]{size}[#ab333d] images per pass")
+
+def txt2img(pixel, device, precision, prompt, negative, W, H, ddim_steps, scale, seed, n_iter, tilingX, tilingY, save=True, cancel=None, preview=None):
+    # Generate the images of a single request
+    return txt2img_batch(pixel, device, precision, W, H, ddim_steps, tilingX, tilingY, [Prompt(prompt, negative, scale, seed, n_iter, cancel, preview)], save)[0]
+
+# Queued txt2img jobs can be sampled together with compatible ones
+batchable.append(txt2img)
+
+def job_prompt(job):
+    # A queued txt2img job's share of a batch
+    arguments = job.arguments()
+    return Prompt(*(arguments[name] for name in ["prompt", "negative", "scale", "seed", "n_iter", "cancel", "preview"]))
+
+def txt2img_batch(pixel, device, precision, W, H, ddim_steps, tilingX, tilingY, prompts, save=True):
+    os.makedirs("temp", exist_ok=True)
+    outpath = "temp"
+
+    timer = time.time()
+    
+    # Set the seed for random number generation if not provided
+    for request in prompts:
+        if request.seed == None:
+            request.seed = randint(0, 1000000)
+    seed_everything(prompts[0].seed)
+
+    n_iter = sum(request.n_iter for request in prompts)
+    shared = f" for [#48a971]{len(prompts)}[white] requests" if len(prompts) > 1 else ""
+    rprint(f"\n[#48a971]Text to Image[white] generating for [#48a971]{n_iter}[white] iterations{shared} with [#48a971]{ddim_steps}[white] steps per iteration at [#48a971]{W}[white]x[#48a971]{H}")
+
+    start_code = None
+    cheap_decode = False
+    sampler = "euler"
+
+    for request in prompts:
+        assert request.prompt is not None
+
+    global model
+    global modelCS
+    global modelFS
+
+    # Patch tiling for model and modelFS
+    model, modelFS = patch_tiling(tilingX, tilingY, model, modelFS)
+
+    # Set the precision scope based on device and precision
+    if device != "cpu" and precision == "autocast":
+        precision_scope = autocast
+    else:
+        precision_scope = nullcontext
+
+    # A shared batch only stops early once all of its requests were cancelled, the others drop their results afterwards
+    cancel = prompts[0].cancel if len(prompts) == 1 else CancelGroup([request.cancel for request in prompts])
+
+    # Hand every request the previews of its own images
+    if len(prompts) == 1:
+        callback = prompts[0].preview
+    elif any(request.preview is not None for request in prompts):
+        def callback(state):
+            offset = 0
+            for request in prompts:
+                if request.preview is not None:
+                    request.preview({**state, "denoised": state["denoised"][offset:offset + request.n_iter]})
+                offset += request.n_iter
+    else:
+        callback = None
+
+    seeds = []
+    outputs = []
+    with torch.no_grad():
+        base_count = 1
+        # Every iteration of every request is generated as one batch
+        for batch in clbar([prompts], name = "Batches", position = "last", unit = "batch", prefixwidth = 12, suffixwidth = 28):
+            # Use the specified precision scope
+            with precision_scope("cuda"):
+                uc, c = [], []
+                for request in batch:
+                    prompt = request.prompt
+                    negative_data = [request.negative]
+
+                    # Split weighted subprompts if multiple prompts are provided
+                    subprompts, weights = split_weighted_subprompts(prompt[0])
+
+                    # Only bring modelCS to the device if some of the prompts are not in the conditioning cache
+                    if len(subprompts) > 1:
+                        texts = [negative_data, [""]] + subprompts
+                    else:
+                        texts = [negative_data, prompt]
+                    encode = not all(modelCS.is_cached(text) for text in texts)
+                    if encode:
+                        residency.use(modelCS)
+                    uc_request = modelCS.get_learned_conditioning(negative_data)
+
+                    if len(subprompts) > 1:
+                        c_request = torch.zeros_like(modelCS.get_learned_conditioning([""]))
+                        totalWeight = sum(weights)
+                        # Normalize each "sub prompt" and add it
+                        for i in range(len(subprompts)):
+                            weight = weights[i]
+                            weight = weight / totalWeight
+                            c_request = torch.add(c_request, modelCS.get_learned_conditioning(subprompts[i]), alpha=weight)
+                    else:
+                        c_request = modelCS.get_learned_conditioning(prompt)
+
+                    # Share the conditioning across the iterations of the request
+                    uc.append(repeat(uc_request, "1 ... -> b ...", b=request.n_iter))
+                    c.append(repeat(c_request, "1 ... -> b ...", b=request.n_iter))
+                uc = torch.cat(uc)
+                c = torch.cat(c)
+                shape = [n_iter, 4, H // 8, W // 8]
+
+                # Image n of a request is seeded with its seed + n
+                sample_seeds = [request.seed + n for request in batch for n in range(request.n_iter)]
+
+                # Requests sharing a batch may ask for different guidance scales, applied per image
+                scale = batch[0].scale
+                if any(request.scale != scale for request in batch):
+                    scale = torch.tensor([request.scale for request in batch for _ in range(request.n_iter)], device=device).view(-1, 1, 1, 1)
+
+                # Generate samples using the model
+                def sample(images):
+                    # Run the conditional and unconditional pass of several images together, low VRAM mode keeps going one at a time
+                    model.unet_bs = 2 * images if model.turbo else 1
+                    return model.sample(
+                        S=ddim_steps,
+                        conditioning=c,
+                        seed=sample_seeds,
+                        shape=shape,
+                        verbose=False,
+                        unconditional_guidance_scale=scale,
+                        unconditional_conditioning=uc,
+                        eta=0.0,
+                        x_T=start_code,
+                        sampler = sampler,
+                        cancel=cancel,
+                        callback=callback,
+                    )
+                samples_ddim = micro_batches(sample, n_iter if model.turbo else 1)
+
+                skip_downscale = False
+                if pixel == "true":
+                    print('Debug: running pixelvae model')
+                    vmodel = load_pixelvae_model("decoder_rd.multibin.hsv444.pt", device)
+                    # Plain mode (no postprocessing)
+                    #x_sample = vmodel.run_plain(samples_ddim)
+                    # Fixed palette mode
+                    #x_sample = vmodel.run_paletted(samples_ddim, [224, 248, 208, 136, 192, 112, 52, 104, 86, 8, 24, 32])
+                    # Pixel clustering mode, lower threshold means bigger clusters
+                    x_samples = [vmodel.run_cluster(samples_ddim[i:i+1], threshold=0.001,
+                        wrap_x=bool(tilingX == "true"), wrap_y=bool(tilingY == "true")) for i in range(n_iter)]
+
+                    # Convert to numpy format, skip downscale later
+                    x_samples = torch.cat(x_samples).cpu().numpy()
+                    skip_downscale = True
+
+                    # free up VRAM
+                    del vmodel
+                elif cheap_decode == False:
+                    residency.use(modelFS)
+                    # Decode the samples using the first stage of the model, several at a time unless in low VRAM mode
+                    def decode(step):
+                        return [modelFS.decode_first_stage(samples_ddim[i:i+step].to(device)).cpu() for i in range(0, n_iter, step)]
+                    x_samples = micro_batches(decode, n_iter if model.turbo else 1)
+                    # Convert the list of decoded samples to a tensor and normalize the values to [0, 1]
+                    x_samples = torch.cat(x_samples).float()
+                    x_samples = torch.clamp((x_samples + 1.0) / 2.0, min=0.0, max=1.0)
+
+                    # Rearrange the dimensions of the tensor and scale the values to the range [0, 255]
+                    x_samples = 255.0 * rearrange(x_samples.numpy(), "b c h w -> b h w c")
+                else:
+                    # Decode the samples using the latents only
+                    x_samples = latent_to_rgb(samples_ddim)
+
+                for x_sample in x_samples:
+                    check_cancel(cancel)
+
+                    # Convert the numpy array to an image
+                    x_sample_image = Image.fromarray(x_sample.astype(np.uint8))
+
+                    if cheap_decode == True:
+                        x_sample_image = x_sample_image.resize((W, H), resample=0)
+
+                    file_name = "temp"
+                    if n_iter > 1:
+                        file_name = "temp" + f"{base_count}"
+                    if pixel == "true" and not skip_downscale:
+                        # Resize the image if pixel is true
+                        x_sample_image = kCentroid(x_sample_image, int(W/8), int(H/8), 2)
+                    if save:
+                        x_sample_image.save(
+                            os.path.join(outpath, file_name + ".png")
+                        )
+                    outputs.append(x_sample_image)
+                    seeds.append(str(sample_seeds[len(seeds)]))
+                    base_count += 1
+
+                # Delete the samples to free up memory
+                del samples_ddim
+        rprint(f"[#c4f129]Image generation completed in [#48a971]{round(time.time()-timer, 2)} [#c4f129]seconds\n[#48a971]Seeds: [#494b9b]{', '.join(seeds)}")
+
+    # Split the images back to the requests they belong to
+    results = []
+    for request in batch:
+        results.append(outputs[:request.n_iter])
+        outputs = outputs[request.n_iter:]
+    return results
+
+def img2img(pixel, device, precision, prompt, negative, W, H, ddim_steps, scale, strength, seed, n_iter, tilingX, tilingY, images=None, cancel=None, preview=None, backend="numpy"):
+    timer = time.time()
+
+    # Take the initial image from memory if provided, otherwise from the plugin's input file
+    if images is None:
+        init_img = "temp/input.png"
+        assert os.path.isfile(init_img)
+    else:
+        init_img = images[0]
+
+    # Load initial image and move it to the specified device
+    init_image = load_img(init_img, H, W).to(device)
+
+    os.makedirs("temp", exist_ok=True)
+    outpath = "temp"
+
+    # Set a random seed if not provided
+    if seed == None:
+        seed = randint(0, 1000000)
+    seed_everything(seed)
+
+    save = images is None
+
+    rprint(f"\n[#48a971]Image to Image[white] generating for [#48a971]{n_iter}[white] iterations with [#48a971]{ddim_steps}[white] steps per iteration at [#48a971]{W}[white]x[#48a971]{H}")
+
+    cheap_decode = False
+    sampler = "ddim"
+
+    assert prompt is not None
+    data = [prompt]
+    negative_data = [negative]
+
+    global model
+    global modelCS
+    global modelFS
+
+    # Patch tiling for model and modelFS
+    model, modelFS = patch_tiling(tilingX, tilingY, model, modelFS)
+
+    # Make sure modelFS is on the specified device
+    residency.use(modelFS)
+
+    # Repeat the initial image for batch processing
+    init_image = repeat(init_image, "1 ... -> b ...", b=1)
+
+    # Move the initial image to latent space and resize it
+    init_latent = modelFS.get_first_stage_encoding(modelFS.encode_first_stage(init_image))
+    init_latent = torch.nn.functional.interpolate(init_latent, size=(H // 8, W // 8), mode="bilinear")
+
+    # Set the precision scope based on device and precision
+    if device != "cpu" and precision == "autocast":
+        precision_scope = autocast
+    else:
+        precision_scope = nullcontext
+
+    seeds = []
+    outputs = []
+    assert 0.0 <= strength <= 1.0, "can only work with strength in [0.0, 1.0]"
+
+    # Calculate the number of steps for encoding
+    t_enc = int(strength * ddim_steps)
+
+    with torch.no_grad():
+        base_count = 1
+
+        # Iterate over the prompts, every iteration of a prompt is generated as one batch
+        for prompts in clbar(data, name = "Batches", position = "last", unit = "batch", prefixwidth = 12, suffixwidth = 28):
+            # Use the specified precision scope
+            with precision_scope("cuda"):
+                if isinstance(prompts, tuple):
+                    prompts = list(prompts)
+
+                # Split weighted subprompts if multiple prompts are provided
+                subprompts, weights = split_weighted_subprompts(prompts[0])
+
+                # Only bring modelCS to the device if some of the prompts are not in the conditioning cache
+                if len(subprompts) > 1:
+                    texts = [negative_data] + subprompts
+                else:
+                    texts = [negative_data, prompts]
+                encode = not all(modelCS.is_cached(text) for text in texts)
+                if encode:
+                    residency.use(modelCS)
+                uc = None
+                uc = modelCS.get_learned_conditioning(negative_data)
+
+                if len(subprompts) > 1:
+                    c = torch.zeros_like(uc)
+                    totalWeight = sum(weights)
+                    # Normalize each "sub prompt" and add it
+                    for i in range(len(subprompts)):
+                        weight = weights[i]
+                        weight = weight / totalWeight
+                        c = torch.add(c, modelCS.get_learned_conditioning(subprompts[i]), alpha=weight)
+                else:
+                    c = modelCS.get_learned_conditioning(prompts)
+
+                # Share the conditioning across the batch
+                uc = repeat(uc, "1 ... -> b ...", b=n_iter)
+                c = repeat(c, "1 ... -> b ...", b=n_iter)
+
+                # Encode the scaled latent, image n is noised with seed + n
+                z_enc = model.stochastic_encode(
+                    repeat(init_latent, "1 ... -> b ...", b=n_iter),
+                    torch.tensor([t_enc] * n_iter).to(device),
+                    seed,
+                    0.0,
+                    ddim_steps,
+                )
+                
+                # Generate samples using the model
+                def sample(images):
+                    # Run the conditional and unconditional pass of several images together, low VRAM mode keeps going one at a time
+                    model.unet_bs = 2 * images if model.turbo else 1
+                    return model.sample(
+                        t_enc,
+                        c,
+                        z_enc,
+                        unconditional_guidance_scale=scale,
+                        unconditional_conditioning=uc,
+                        sampler = sampler,
+                        cancel=cancel,
+                        callback=preview,
+                    )
+                samples_ddim = micro_batches(sample, n_iter if model.turbo else 1)
+
+                if cheap_decode == False:
+                    residency.use(modelFS)
+                    # Pixel samples are downscaled with the tensor backend where they are decoded, only the small results are copied back
+                    on_device = backend == "torch" and pixel == "true"
+
+                    # Decode the samples using the first stage of the model, several at a time unless in low VRAM mode
+                    def decode(step):
+                        return [modelFS.decode_first_stage(samples_ddim[i:i+step].to(device)) for i in range(0, n_iter, step)]
+                    x_samples = micro_batches(decode, n_iter if model.turbo else 1)
+                    # Convert the list of decoded samples to a tensor and normalize the values to [0, 1]
+                    x_samples = torch.cat([x_sample if on_device else x_sample.cpu() for x_sample in x_samples]).float()
+                    x_samples = torch.clamp((x_samples + 1.0) / 2.0, min=0.0, max=1.0)
+
+                    # Rearrange the dimensions of the tensor and scale the values to the range [0, 255]
+                    if on_device:
+                        x_samples = 255.0 * rearrange(x_samples, "b c h w -> b h w c")
+                    else:
+                        x_samples = 255.0 * rearrange(x_samples.numpy(), "b c h w -> b h w c")
+                else:
+                    # Decode the samples using the latents only
+                    x_samples = latent_to_rgb(samples_ddim)
+
+                for x_sample in x_samples:
+                    check_cancel(cancel)
+
+                    file_name = "temp"
+                    if n_iter > 1:
+                        file_name = "temp" + f"{base_count}"
+
+                    if isinstance(x_sample, torch.Tensor):
+                        # Resize the decoded tensor and convert only the result to an image
+                        x_sample_image = postprocess_torch.to_image(postprocess_torch.kCentroid(x_sample.to(torch.uint8), int(W/8), int(H/8), 2))
+                    else:
+                        # Convert the numpy array to an image
+                        x_sample_image = Image.fromarray(x_sample.astype(np.uint8))
+
+                        if cheap_decode == True:
+                            x_sample_image = x_sample_image.resize((W, H), resample=0)
+
+                        if pixel == "true":
+                            # Resize the image if pixel is true
+                            x_sample_image = kCentroid(x_sample_image, int(W/8), int(H/8), 2)
+                    if save:
+                        x_sample_image.save(
+                            os.path.join(outpath, file_name + ".png")
+                        )
+                    outputs.append(x_sample_image)
+                    seeds.append(str(seed))
+                    seed += 1
+                    base_count += 1
+
+                # Delete the samples to free up memory
+                del samples_ddim
+        rprint(f"[#c4f129]Image generation completed in [#48a971]{round(time.time()-timer, 2)} seconds\n[#48a971]Seeds: [#494b9b]{', '.join(seeds)}")
+    return outputs
+
+def decode_image(data):
+    # Binary frames carry either a complete PNG file or raw RGBA pixels behind a width/height header
+    # Damaged or truncated frames raise ValueError or OSError here instead of in the operation using them
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        image = Image.open(BytesIO(data))
+        image.load()
+        return image
+    if len(data) < 8:
+        raise ValueError(f"Binary frame of {len(data)} bytes is too short for a header")
+    width, height = struct.unpack("<II", data[:8])
+    if len(data) - 8 != 4 * width * height:
+        raise ValueError(f"RGBA frame of {width}x{height} needs {4 * width * height} bytes of pixels, got {len(data) - 8}")
+    return Image.frombytes("RGBA", (width, height), data[8:])
+
+def encode_image(image, transport):
+    # Encode a result image for the client in the format it asked for
+    if transport == "rgba":
+        image = image.convert("RGBA")
+        return struct.pack("<II", image.width, image.height) + image.tobytes()
+
+    # Fast compression, the frame never touches the disk
+    buffer = BytesIO()
+    image.save(buffer, format="PNG", compress_level=1)
+    return buffer.getvalue()
+
+def previewer(websocket, transport, every):
+    # Sampler callback sending a cheap decode of the current denoised latents to the client every few steps
+    if every <= 0:
+        return None
+    loop = asyncio.get_event_loop()
+    transport = transport if transport != "file" else "png"
+
+    # Sends still in flight, the worker settles them before the job's results go out
+    pending = []
+
+    async def send(step, previews, previous):
+        # Encoding happens off the inference thread, the header tells the client how many frames follow
+        frames = [await loop.run_in_executor(None, encode_image, image, transport) for image in previews]
+
+        # Previews go out one after another in step order, so the frames of two previews never mix
+        if previous is not None:
+            await asyncio.wait([asyncio.wrap_future(previous)])
+        await reply(websocket, f"preview {step} {len(frames)}")
+        for frame in frames:
+            await reply(websocket, frame)
+
+    def preview(state):
+        if (state["i"] + 1) % every != 0:
+            return
+        # Project the latents and upscale them to the output size by repeating pixels
+        previews = [Image.fromarray(x.astype(np.uint8)) for x in latent_to_rgb(state["denoised"])]
+        previews = [image.resize((image.width * 8, image.height * 8), resample=Image.Resampling.NEAREST) for image in previews]
+        previous = pending[-1] if pending else None
+        pending.append(asyncio.run_coroutine_threadsafe(send(state["i"] + 1, previews, previous), loop))
+    preview.pending = pending
+    return preview
+
+async def settle_previews(job, drop=False):
+    # Finish sending the job's previews before anything else goes to its client, or drop them when the job was abandoned
+    preview = job.kwargs.get("preview")
+    if preview is None or not preview.pending:
+        return
+    if drop:
+        for future in preview.pending:
+            future.cancel()
+    await asyncio.wait([asyncio.wrap_future(future) for future in preview.pending])
+    preview.pending.clear()
+
+jobs = JobQueue()
+
+async def reply(websocket, message):
+    # Send a message to a client, ignoring clients that disconnected while their job was waiting
+    try:
+        await websocket.send(message)
+    except ConnectionClosed:
+        pass
+
+async def enqueue(websocket, transport, running, returning, func, *args, tokens=None, **kwargs):
+    # Report how many jobs are ahead of this one, the client is told when it actually starts
+    position = jobs.qsize() + int(current is not None)
+    jobs.put(Job(websocket, transport, running, returning, func, *args, tokens=tokens, **kwargs))
+    if position > 0:
+        await reply(websocket, f"queued {position}")
+
+async def worker():
+    global current
+    loop = asyncio.get_event_loop()
+
+    # Take jobs off the queue one at a time, or a batch of compatible ones, and hand them to the inference thread
+    while True:
+        job = await jobs.get()
+        # The job counts as running while its batch is gathered, so status and queue positions already include it
+        current = job
+        batch = await jobs.gather(job)
+        taken = list(batch)
+        cancelled = False
+        try:
+            # Jobs cancelled while they were waiting never start
+            for other in cancelled_jobs(batch):
+                batch.remove(other)
+                await reply(other.websocket, "returning cancelled")
+            if not batch:
+                continue
+
+            # The batch runs as its first remaining job
+            job = batch[0]
+            current = job
+
+            for other in batch:
+                await reply(other.websocket, other.running)
+            if len(batch) == 1:
+                results = [await loop.run_in_executor(inference, partial(job.func, *job.args, **job.kwargs))]
+            else:
+                results = await loop.run_in_executor(inference, partial(txt2img_batch, *job.batch(), [job_prompt(other) for other in batch], save=False))
+
+            for other, outputs in zip(batch, results):
+                # Requests cancelled while sharing a batch with others drop their results
+                if other.cancel is not None and other.cancel.cancelled:
+                    cancelled = True
+                    await settle_previews(other, drop=True)
+                    await reply(other.websocket, "returning cancelled")
+                    continue
+
+                # The last previews of the job arrive before its results
+                await settle_previews(other)
+
+                # Results travel back as binary frames ahead of the returning message when the client asked for it
+                if other.transport != "file" and outputs:
+                    for image in outputs:
+                        await reply(other.websocket, await loop.run_in_executor(None, encode_image, image, other.transport))
+                await reply(other.websocket, other.returning)
+        except Cancelled:
+            rprint("\n[#ab333d]Cancelled")
+            cancelled = True
+            for other in batch:
+                await settle_previews(other, drop=True)
+                await reply(other.websocket, "returning cancelled")
+        except Exception as e:
+            rprint(f"\n[#ab333d]ERROR:\n{traceback.format_exc()}")
+            for other in batch:
+                await settle_previews(other, drop=True)
+                await reply(other.websocket, "returning error")
+        finally:
+            current = None
+            for other in taken:
+                other.finish()
+
+        # Give the memory held by the abandoned generation back once its frames are gone
+        if cancelled:
+            await loop.run_in_executor(inference, free_memory)
+
+def free_memory():
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+def load(message, path, modelfile, device, precision, optimized):
+    global loaded
+    # Only reload when the requested model or its settings changed
+    if loaded != message:
+        try:
+            load_model(path, modelfile, "scripts/v1-inference.yaml", device, precision, optimized)
+            loaded = message
+        except Exception as e: rprint(f"\n[#ab333d]ERROR:\n{e}")
+
+def setting(value, allowed):
+    # A connection setting, only stored when it is one of the allowed values
+    if value not in allowed:
+        raise ValueError(f"Unknown setting {value!r}, expected one of {', '.join(allowed)}")
+    return value
+
+async def server(websocket):
+    background = False
+
+    # Images are exchanged through files in temp unless the client selects a binary transport
+    transport = "file"
+    frames = []
+
+    def take_frames():
+        # In-memory operations consume all images received since the last one
+        nonlocal frames
+        images, frames = frames, []
+        return images if transport != "file" else None
+
+    # Steps between latent previews during generation, 0 turns them off
+    previews = 0
+
+    # Color space palette colors are matched in, "rgb" or the perceptual "oklab"
+    colorspace = "rgb"
+
+    # Post-processing backend, "numpy" on PIL images or "torch" on tensors on the GPU, or the CPU without one
+    # "torch" covers kcentroid, the grid downscale of pixeldetect, the downscale of img2img pixel samples, denoising,
+    # mapping to a fixed palette and Bayer dithering with its gamma adjustment, all giving the same pixels as "numpy"
+    # Picking the number of colors, adaptive palettes and error diffusion quantize with PIL and stay on the CPU with
+    # either backend, as does txt2img, whose pixel samples leave the pixel VAE already at their final size
+    backend = "numpy"
+
+    # Cancellation tokens of the jobs this client submitted, a cancel message sets all of them
+    tokens = []
+
+    def token():
+        tokens.append(CancelToken())
+        return tokens[-1]
+
+    async for message in websocket:
+        if isinstance(message, bytes):
+            # Collect input images for the next operation
+            try:
+                frames.append(decode_image(message))
+            except Exception as e:
+                rprint(f"\n[#ab333d]ERROR:\n{traceback.format_exc()}")
+                # The next operation would run on an incomplete set of images, drop the ones received so far
+                frames = []
+                await reply(websocket, "returning error")
+            continue
+
+        if re.search(r"txt2img.+", message):
+            # Extract parameters from the message
+            try:
+                pixel, device, precision, prompt, negative, w, h, ddim_steps, scale, seed, n_iter, tilingX, tilingY = searchString(message, "dpixel", "ddevice", "dprecision", "dprompt", "dnegative", "dwidth", "dheight", "dstep", "dscale", "dseed", "diter", "dtilingx", "dtilingy", "end")
+                images = take_frames()
+                await enqueue(websocket, transport, "running txt2img", "returning txt2img", txt2img, pixel, device, precision, prompt, negative, int(w), int(h), int(ddim_steps), float(scale), int(seed), int(n_iter), tilingX, tilingY, save=images is None, cancel=token(), tokens=tokens, preview=previewer(websocket, transport, previews))
+            except Exception as e:
+                rprint(f"\n[#ab333d]ERROR:\n{traceback.format_exc()}")
+                await reply(websocket, "returning error")
+
+        elif re.search(r"txt2pal.+", message):
+            # Extract parameters from the message
+            try:
+                device, precision, prompt, seed, colors = searchString(message, "ddevice", "dprecision", "dprompt", "dseed", "dcolors", "end")
+                images = take_frames()
+                await enqueue(websocket, transport, "running txt2pal", "returning txt2pal", paletteGen, int(colors), device, precision, prompt, int(seed), save=images is None, cancel=token(), tokens=tokens)
+            except Exception as e:
+                rprint(f"\n[#ab333d]ERROR:\n{traceback.format_exc()}")
+                await reply(websocket, "returning error")
+
+        elif re.search(r"img2img.+", message):
+            # Extract parameters from the message
+            try:
+                pixel, device, precision, prompt, negative, w, h, ddim_steps, scale, strength, seed, n_iter, tilingX, tilingY = searchString(message, "dpixel", "ddevice", "dprecision", "dprompt", "dnegative", "dwidth", "dheight", "dstep", "dscale", "dstrength", "dseed", "diter", "dtilingx", "dtilingy", "end")
+                images = take_frames()
+                await enqueue(websocket, transport, "running img2img", "returning img2img", img2img, pixel, device, precision, prompt, negative, int(w), int(h), int(ddim_steps), float(scale), float(strength)/100, int(seed), int(n_iter), tilingX, tilingY, images=images, cancel=token(), tokens=tokens, preview=previewer(websocket, transport, previews), backend=backend)
+            except Exception as e:
+                rprint(f"\n[#ab333d]ERROR:\n{traceback.format_exc()}")
+                await reply(websocket, "returning error")
+
+        elif re.search(r"palettize.+", message):
+            # Extract parameters from the message
+            try:
+                numFiles, source, colors, accuracy, paletteFile, paletteURL, dithering, strength, denoise, smoothness, intensity = searchString(message, "dnumfiles", "dsource", "dcolors", "daccuracy", "dpalettefile", "dpaletteURL", "ddithering", "dstrength", "ddenoise", "dsmoothness", "dintensity", "end")
+                images = take_frames()
+                # Bayer orders are numbers, error diffusion kernels are named
+                dithering = dithering if dithering in DIFFUSION_KERNELS else int(dithering)
+                await enqueue(websocket, transport, "running palettize", "returning palettize", palettize, int(numFiles), source,  int(colors), int(accuracy), paletteFile, paletteURL, dithering, int(strength), denoise, int(smoothness), int(intensity), images=images, cancel=token(), tokens=tokens, space=colorspace, backend=backend)
+            except Exception as e:
+                rprint(f"\n[#ab333d]ERROR:\n{traceback.format_exc()}")
+                await reply(websocket, "returning error")
+
+        elif re.search(r"rembg.+", message):
+            # Extract parameters from the message
+            try:
+                numFiles = searchString(message, "dnumfiles", "end")
+                images = take_frames()
+                await enqueue(websocket, transport, "running rembg", "returning rembg", rembg, int(numFiles[0]), images=images)
+            except Exception as e:
+                rprint(f"\n[#ab333d]ERROR:\n{traceback.format_exc()}")
+                await reply(websocket, "returning error")
+
+        elif re.search(r"pixelDetect.+", message):
+            images = take_frames()
+            await enqueue(websocket, transport, "running pixelDetect", "returning pixelDetect", pixelDetectVerbose, images=images, backend=backend)
+
+        elif re.search(r"kcentroid.+", message):
+            # Extract parameters from the message
+            try:
+                width, height, centroids = searchString(message, "dwidth", "dheight", "dcentroids", "end")
+                images = take_frames()
+                await enqueue(websocket, transport, "running kcentroid", "returning kcentroid", kCentroidVerbose, int(width), int(height), int(centroids), images=images, backend=backend)
+            except Exception as e:
+                rprint(f"\n[#ab333d]ERROR:\n{traceback.format_exc()}")
+                await reply(websocket, "returning error")
+
+        elif re.search(r"load.+", message):
+            # Extract parameters from the message
+            try:
+                device, optimized, precision, path, modelfile = searchString(message, "ddevice", "doptimized", "dprecision", "dpath", "dmodel", "end")
+                await enqueue(websocket, transport, "loading model", "loaded model", load, message, path, modelfile, device, precision, optimized)
+            except Exception as e:
+                rprint(f"\n[#ab333d]ERROR:\n{traceback.format_exc()}")
+                await reply(websocket, "returning error")
+
+        elif re.search(r"transport.+", message):
+            # Select "file", "png" or "rgba" image exchange for this connection
+            try:
+                transport = setting(searchString(message, "dtransport", "end")[0], transports)
+                await websocket.send(f"transport {transport}")
+            except Exception as e:
+                rprint(f"\n[#ab333d]ERROR:\n{traceback.format_exc()}")
+                await reply(websocket, "returning error")
+
+        elif re.search(r"previews.+", message):
+            # Stream a latent preview every k steps of this connection's generations
+            try:
+                previews = int(searchString(message, "dpreviews", "end")[0])
+                await websocket.send(f"previews {previews}")
+            except Exception as e:
+                rprint(f"\n[#ab333d]ERROR:\n{traceback.format_exc()}")
+                await reply(websocket, "returning error")
+
+        elif re.search(r"colorspace.+", message):
+            # Match palette colors of this connection's palettize operations in "rgb" or "oklab"
+            try:
+                colorspace = setting(searchString(message, "dcolorspace", "end")[0], colorspaces)
+                await websocket.send(f"colorspace {colorspace}")
+            except Exception as e:
+                rprint(f"\n[#ab333d]ERROR:\n{traceback.format_exc()}")
+                await reply(websocket, "returning error")
+
+        elif re.search(r"backend.+", message):
+            # Run this connection's post-processing with "numpy" or "torch"
+            try:
+                backend = setting(searchString(message, "dbackend", "end")[0], backends)
+                await websocket.send(f"backend {backend}")
+            except Exception as e:
+                rprint(f"\n[#ab333d]ERROR:\n{traceback.format_exc()}")
+                await reply(websocket, "returning error")
+
+        elif re.search(r"connected.+", message):
+            try:
+                background = searchString(message, "dbackground", "end")[0]
+            except Exception as e:
+                rprint(f"\n[#ab333d]ERROR:\n{traceback.format_exc()}")
+                await reply(websocket, "returning error")
+                continue
+            rd = gw.getWindowsWithTitle("Retro Diffusion Image Generator")[0]
+            if background == "false":
+                try:
+                    # Restore and activate the window
+                    rd.restore()
+                    rd.activate()
+                except:
+                    pass
+            else:
+                try:
+                    # Minimize the window
+                    rd.minimize()
+                except:
+                    pass
+            await websocket.send("connected")
+        elif message == "no model":
+            await websocket.send("loaded model")
+        elif message == "recieved":
+            if background == "false":
+                rd = gw.getWindowsWithTitle("Retro Diffusion Image Generator")[0]
+                if gw.getActiveWindow() is not None:
+                    if gw.getActiveWindow().title == "Retro Diffusion Image Generator":
+                        # Minimize the window
+                        rd.minimize()
+            await websocket.send("free")
+        elif message == "cancel":
+            # Stop the running job of this client between steps and drop the ones it still has queued
+            for cancel in tokens:
+                cancel.cancel()
+            tokens.clear()
+            await websocket.send("cancelling")
+        elif message == "status":
+            # Answered straight from the event loop, even while a generation is running
+            state = current.running if current is not None else "free"
+            cache = CondStage.cache
+            await websocket.send(f"status {state} queued {jobs.qsize()} conditioning hits {cache.hits} misses {cache.misses}")
+        elif message == "shutdown":
+            rprint("[#ab333d]Shutting down...")
+            global running
+            global timeout
+            running = False
+            inference.shutdown(wait=False)
+            if palettizer is not None:
+                # Frames not started yet are dropped, shutdown only learned to cancel them itself in Python 3.9
+                for future in list(palettizing):
+                    future.cancel()
+                palettizer.shutdown(wait=False)
+            await websocket.close()
+            asyncio.get_event_loop().call_soon_threadsafe(asyncio.get_event_loop().stop)
+
+async def connectSend(uri, message):
+    async with connect(uri) as websocket:
+        # Send a message over the WebSocket connection
+        await websocket.send(message)
+
+def main():
+    # Started by image_server.py, which keeps the worker processes from importing this module
+    global timeout
+
+    os.system("title Retro Diffusion Image Generator")
+
+    rprint("\n" + climage("logo.png", "centered") + "\n\n")
+
+    rprint("[#48a971]Starting Image Generator...")
+
+    start_server = serve(server, "localhost", 8765)
+
+    rprint("[#c4f129]Connected")
+
+    timeout = 1
+
+    # Run the server until it is completed
+    asyncio.get_event_loop().run_until_complete(start_server)
+    asyncio.get_event_loop().create_task(worker())
+    asyncio.get_event_loop().run_forever()
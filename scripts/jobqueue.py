@@ -0,0 +1,111 @@
+import asyncio
+from collections import deque
+from inspect import signature
+
+# Jobs of the image server waiting for the inference thread, kept apart from the model code so the queue imports on its own
+
+# Compatible txt2img jobs of clients exchanging images in memory are sampled together, up to this many images
+batch_max = 8
+# Seconds a batch of compatible jobs stays open for more to join it
+batch_window = 0.05
+# Settings jobs must share to be sampled together, everything else is carried per job
+batch_settings = ["pixel", "device", "precision", "W", "H", "ddim_steps", "tilingX", "tilingY"]
+# Functions whose jobs can be sampled together, registered by the server
+batchable = []
+
+class Job:
+    # A blocking operation requested by a client, run in order on the inference thread
+    def __init__(self, websocket, transport, running, returning, func, *args, tokens=None, **kwargs):
+        self.websocket = websocket
+        self.transport = transport
+        self.running = running
+        self.returning = returning
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.cancel = kwargs.get("cancel")
+        # Cancellation tokens of the client's unfinished jobs, the job's own token leaves it when the job is done
+        self.tokens = tokens
+
+    def arguments(self):
+        # Arguments of the call by parameter name, including defaults
+        bound = signature(self.func).bind(*self.args, **self.kwargs)
+        bound.apply_defaults()
+        return bound.arguments
+
+    def finish(self):
+        if self.tokens is not None and self.cancel in self.tokens:
+            self.tokens.remove(self.cancel)
+
+    def batch(self):
+        # Jobs keeping their results in memory can share a txt2img batch with compatible jobs of other clients
+        if self.func not in batchable:
+            return None
+        arguments = self.arguments()
+        if arguments["save"]:
+            return None
+        return tuple(arguments[name] for name in batch_settings)
+
+def cancelled_jobs(batch):
+    # Jobs of a batch that were cancelled while they waited in the queue
+    return [job for job in batch if job.cancel is not None and job.cancel.cancelled]
+
+class JobQueue:
+    # Pending jobs in submission order, compatible jobs can be taken out from further back to join a batch
+    def __init__(self):
+        self.pending = deque()
+        self.added = asyncio.Event()
+
+    def qsize(self):
+        return len(self.pending)
+
+    def put(self, job):
+        self.pending.append(job)
+        self.added.set()
+
+    async def get(self):
+        while not self.pending:
+            self.added.clear()
+            await self.added.wait()
+        return self.pending.popleft()
+
+    def take(self, key, images):
+        # Remove the pending jobs with a matching batch key, in order, as long as their images fit
+        # The scan stops at the first job that cannot join a batch, jobs behind a model load have to run on the new model
+        taken = []
+        for job in list(self.pending):
+            batch = job.batch()
+            if batch is None:
+                break
+            if batch == key and job.arguments()["n_iter"] <= images:
+                self.pending.remove(job)
+                taken.append(job)
+                images -= job.arguments()["n_iter"]
+        return taken
+
+    async def wait(self, timeout):
+        # Wait until another job is added or the timeout passes
+        self.added.clear()
+        try:
+            await asyncio.wait_for(self.added.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def gather(self, job):
+        # Collect compatible jobs to run together with this one, waiting a short moment for more to arrive
+        # A job without compatible jobs queued behind it starts at once, the wait only keeps an actual batch open
+        key = job.batch()
+        if key is None:
+            return [job]
+        loop = asyncio.get_event_loop()
+        batch = [job]
+        images = batch_max - job.arguments()["n_iter"]
+        deadline = loop.time() + batch_window
+        while images > 0:
+            for other in self.take(key, images):
+                batch.append(other)
+                images -= other.arguments()["n_iter"]
+            if images <= 0 or len(batch) == 1 or loop.time() >= deadline:
+                break
+            await self.wait(deadline - loop.time())
+        return batch
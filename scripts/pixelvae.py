@@ -154,6 +154,22 @@ def net_output_to_color8_pal(binning, predicts, pal):
 NEIGHBOURHOOD8 = [(-1, -1), (-1, 0), (-1, 1), ( 0, -1), ( 0, 1), ( 1, -1), ( 1, 0), ( 1, 1)]
 NEIGHBOURHOOD4 = [(-1, 0), ( 0, -1), ( 0, 1), ( 1, 0)]
 
+def neighbour_table(width, height, neighbourhood, wrap_x=False, wrap_y=False):
+    '''Flat index of every neighbour of every pixel as [height*width, len(neighbourhood)], height*width where it falls outside the image.'''
+    import numpy as np
+    y, x = np.mgrid[0:height, 0:width]
+    table = []
+    for (xi, yi) in neighbourhood:
+        xp, yp = x + xi, y + yi
+        # handle wrap-around boundary conditions, if requested
+        if wrap_x:
+            xp %= width
+        if wrap_y:
+            yp %= height
+        inside = (xp >= 0) & (yp >= 0) & (xp < width) & (yp < height)
+        table.append(np.where(inside, yp * width + xp, height * width))
+    return np.stack(table, -1).reshape(height * width, -1)
+
 class PixelVAE:
     def __init__(self, device, model, binning):
         self.device = device
@@ -191,83 +207,69 @@ class PixelVAE:
         height = bins[0].shape[1]
         width = bins[0].shape[2]
 
-        cats = torch.zeros((3, height, width), dtype=torch.uint8)
+        cats = np.zeros((3, height * width), dtype=np.uint8)
 
         # predictable generator to shuffle visiting order
         visit_order = list((x, y) for y in range(height) for x in range(width))
         generator = random.Random(rand_seed)
         generator.shuffle(visit_order)
 
-        # keep track of visited pixels
-        visited = torch.zeros((height, width), dtype=torch.uint8)
+        # keep track of visited pixels, with one extra entry that stands for everything outside the image
+        visited = np.zeros(height * width + 1, dtype=bool)
+        visited[-1] = True
 
         # precompute maximum product for each pixel
         maxprod = np.max(bins[0], axis=0) * np.max(bins[1], axis=0) * np.max(bins[2], axis=0)
         # multiply with the relative threshold to get per-pixel threshold
         pixel_threshold = maxprod * threshold
 
-        def flood_fill(x, y):
-            queue = [(x, y)]
-            while queue:
-                (x, y) = queue.pop()
-                for (xi, yi) in neighbourhood:
-                    xp, yp = x + xi, y + yi
-                    if xp < 0 or yp < 0 or xp >= width or yp >= height:
-                        # handle wrap-around boundary conditions, if requested
-                        if wrap_x:
-                            if xp < 0:
-                                xp += width
-                            elif xp >= width:
-                                xp -= width
-                        if wrap_y:
-                            if yp < 0:
-                                yp += height
-                            elif yp >= height:
-                                yp -= height
-                        # if still out of bounds, skip pixel
-                        if xp < 0 or yp < 0 or xp >= width or yp >= height:
-                            continue
-                    hsub, ssub, vsub = bins[0][hh,yp,xp], bins[1][ss,yp,xp], bins[2][vv,yp,xp]
-
-                    if not visited[yp, xp] and hsub * ssub * vsub >= pixel_threshold[yp,xp]:
-                        cats[:,yp,xp] = torch.Tensor([hh, ss, vv])
-                        visited[yp, xp] = True
-                        queue.append((xp, yp))
-
-        def select_global(x, y):
-            for yp in range(height):
-                for xp in range(width):
-                    hsub, ssub, vsub = bins[0][hh,yp,xp], bins[1][ss,yp,xp], bins[2][vv,yp,xp]
-
-                    if not visited[yp, xp] and hsub * ssub * vsub >= pixel_threshold[yp,xp]:
-                        cats[:,yp,xp] = torch.Tensor([hh, ss, vv])
-                        visited[yp, xp] = True
+        # most likely color of every pixel, the color a cluster seeded there gets
+        best = [np.argmax(channel, axis=0).ravel() for channel in bins]
+
+        # flat views to look up the probabilities of any set of pixels at once
+        flat = [channel.reshape(len(channel), -1) for channel in bins]
+        pixel_threshold = pixel_threshold.ravel()
 
         if select == 'local8':
-            visit = flood_fill
             neighbourhood = NEIGHBOURHOOD8
         elif select == 'local4':
-            visit = flood_fill
             neighbourhood = NEIGHBOURHOOD4
         elif select == 'global':
-            visit = select_global
+            neighbourhood = None
         else:
             raise NotImplemented
 
+        if neighbourhood is not None:
+            neighbours = neighbour_table(width, height, neighbourhood, wrap_x, wrap_y)
+
         # random sampling
         for (x, y) in visit_order:
-            if visited[y, x]:
+            seed = y * width + x
+            if visited[seed]:
                 continue
 
-            hh = np.argmax(bins[0][:,y,x])
-            ss = np.argmax(bins[1][:,y,x])
-            vv = np.argmax(bins[2][:,y,x])
+            hh, ss, vv = best[0][seed], best[1][seed], best[2][seed]
+            color = np.array([[hh], [ss], [vv]], dtype=np.uint8)
+            cats[:, seed] = color[:, 0]
+            visited[seed] = True
 
-            cats[:,y,x] = torch.Tensor([hh, ss, vv])
-            visited[y, x] = True
+            if neighbourhood is None:
+                # every pixel accepting the seed color that is not taken yet joins the cluster
+                cluster = np.flatnonzero((flat[0][hh] * flat[1][ss] * flat[2][vv] >= pixel_threshold) & ~visited[:-1])
+                cats[:, cluster] = color
+                visited[cluster] = True
+                continue
 
-            visit(x, y)
+            # grow the cluster from the seed one ring of neighbours at a time, only testing the pixels next to it
+            frontier = np.array([seed])
+            while len(frontier):
+                frontier = np.unique(neighbours[frontier])
+                frontier = frontier[~visited[frontier]]
+                frontier = frontier[flat[0][hh, frontier] * flat[1][ss, frontier] * flat[2][vv, frontier] >= pixel_threshold[frontier]]
+                cats[:, frontier] = color
+                visited[frontier] = True
 
+        cats = torch.from_numpy(cats.reshape(3, height, width))
         result = self.binning.cats_to_rgb8(cats[None])
         result = result.permute(0, 2, 3, 1)
         return result
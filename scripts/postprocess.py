@@ -0,0 +1,738 @@
+import hashlib
+from collections import OrderedDict
+from itertools import product
+from math import exp, lgamma, log
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from PIL import Image
+
+# Vectorized pixel art post-processing, working on whole images as arrays instead of one PIL call per tile
+
+# Lookup tables of recently used palettes, least recently used dropped first
+palette_cache_size = 16
+palette_cache = OrderedDict()
+
+def block_bounds(size, count):
+    # Pixel ranges of count blocks covering size pixels, rounded the way PIL rounds crop boxes
+    factor = size / count
+    starts = np.array([round(i * factor) for i in range(count)])
+    ends = np.array([round(i * factor + factor) for i in range(count)])
+
+    # Keep every block at least one pixel wide when upscaling
+    starts = np.minimum(starts, size - 1)
+    ends = np.clip(ends, starts + 1, size)
+    return starts, ends
+
+def block_view(pixels, xs, xe, ys, ye):
+    # Gather the blocks with the given pixel ranges of an [H, W, C] array into [rows, columns, bh*bw, C], with a mask of the valid pixels
+    # Blocks of non-integer scale factors differ in size and are padded to the largest one
+    bw, bh = int((xe - xs).max()), int((ye - ys).max())
+    if np.array_equal(xs, xs[0] + bw * np.arange(len(xs))) and np.array_equal(ys, ys[0] + bh * np.arange(len(ys))) \
+            and (xe - xs == bw).all() and (ye - ys == bh).all():
+        # Blocks tiling the image evenly are a reshape of it
+        blocks = pixels[ys[0]:ye[-1], xs[0]:xe[-1]].reshape(len(ys), bh, len(xs), bw, -1).transpose(0, 2, 1, 3, 4)
+        return blocks.reshape(len(ys), len(xs), bh * bw, -1), np.ones((len(ys), len(xs), bh * bw), dtype=bool)
+
+    xi = xs[:, None] + np.arange(bw)
+    yi = ys[:, None] + np.arange(bh)
+    xvalid = xi < xe[:, None]
+    yvalid = yi < ye[:, None]
+    xi = np.minimum(xi, pixels.shape[1] - 1)
+    yi = np.minimum(yi, pixels.shape[0] - 1)
+
+    blocks = pixels[yi[:, :, None, None], xi[None, None, :, :]]
+    blocks = blocks.transpose(0, 2, 1, 3, 4).reshape(len(ys), len(xs), bh * bw, -1)
+    mask = (yvalid[:, None, :, None] & xvalid[None, :, None, :]).reshape(len(ys), len(xs), bh * bw)
+    return blocks, mask
+
+def table_size(size):
+    # Size PIL's color hash table grows to, the first number from size whose low four bits are 1, 3, 7, 9, 11 or 13
+    while size & 15 not in (1, 3, 7, 9, 11, 13):
+        size += 1
+    return size
+
+def hash_order(blocks, mask):
+    # Sort key [B, P] of the order PIL walks its hash table of the colors of every block in: by bucket, then by R, G and B
+    r, g, b = (blocks[..., c].astype(np.int64) for c in range(3))
+    bucket = ((r * 463) ^ ((g << 8) * 10069) ^ ((b << 16) * 64997)) & 0xFFFFFFFF
+
+    # The table starts with 11 buckets and grows as colors are added, so its size follows the number of unique colors
+    length = np.full(len(mask), 11, dtype=np.int64)
+    if mask.shape[1] > 33:
+        packed = np.sort(np.where(mask, r << 16 | g << 8 | b, -1), -1)
+        unique = 1 + (packed[:, 1:] != packed[:, :-1]).sum(-1) - (~mask).any(-1)
+        sizes = [11]
+        while sizes[-1] * 3 < unique.max():
+            sizes.append(table_size(2 * sizes[-1] + 1))
+        length = np.array(sizes)[np.searchsorted(np.array(sizes) * 3, unique)]
+    return (bucket % length[:, None]) << 24 | r << 16 | g << 8 | b
+
+def nearest_centroid(pixels, centroids, padding, current):
+    # Index of the nearest centroid [B, k, C] for every pixel of pixels [B, P, C + 1], whose last column is ones
+    # The nearest centroid has the largest x·c - |c|²/2, one batched matrix product that is exact for 8 bit colors.
+    # Like PIL a pixel stays in its current cluster unless another centroid is strictly nearer.
+    # Padding pixels, 255 in padding, belong to no cluster
+    k = centroids.shape[1]
+    scores = pixels @ np.concatenate([centroids, -0.5 * (centroids ** 2).sum(-1, keepdims=True)], -1).transpose(0, 2, 1)
+
+    # Labels are raised arithmetically, masked stores are much slower on the scattered masks this produces
+    labels = np.zeros(padding.shape, dtype=np.uint8)
+    best = scores[..., 0]
+    for j in range(1, k):
+        labels += (scores[..., j] > best).view(np.uint8) * (j - labels)
+        best = np.maximum(best, scores[..., j])
+    ties = sum((scores[..., j] == best).view(np.uint8) for j in range(k))
+    current = np.minimum(current, k - 1)
+    kept = sum(scores[..., j] * (current == j) for j in range(k)) >= best
+    labels = np.where(kept, current, labels)
+
+    # PIL searches the other centroids in order of their distance to the current one, ties by index,
+    # so of several equally near centroids the one closest to the current centroid wins
+    b, p = np.nonzero((ties > 1) & ~kept)
+    if len(b):
+        between = ((centroids[b] - centroids[b, current[b, p]][:, None]) ** 2).sum(-1)
+        labels[b, p] = np.where(scores[b, p] == best[b, p, None], between * k + np.arange(k), np.inf).argmin(-1)
+    return labels | padding
+
+def cluster_sums(labels, pixels, k):
+    # Summed colors [B, k, C] and sizes [B, k] of the clusters, one batched product of the cluster memberships with the pixels
+    sums = (labels[:, None] == np.arange(k, dtype=np.uint8)[:, None]).astype(np.float32) @ pixels
+    return sums[..., :-1], sums[..., -1]
+
+def kmeans_blocks(blocks, mask, k, iterations=256):
+    # Cluster the pixels of every block [B, P, C] into k colors at once the way PIL's quantize(method=1, kmeans=k) does,
+    # returning integer centroids [B, k, C], cluster sizes [B, k] and the cluster of every pixel [B, P]
+    # It follows PIL's steps: the same starting colors, rounded means, empty clusters turning black, ties broken in the
+    # order PIL searches its tables and a block stopping once fewer than k of its pixels change cluster. Two rare cases
+    # are not followed: PIL re-sorting its centroid distance lists with a faulty insertion sort, and its getcolors
+    # moving colors that share a hash slot. How often the result still differs is measured on real images in
+    # tests/test_postprocess.py
+    count, size, channels = blocks.shape
+    padding = np.where(mask, 0, 255).astype(np.uint8)
+
+    # Pixels followed by a one [B, P, C + 1], so that finding the nearest centroids and summing the clusters
+    # are batched matrix products
+    pixels = np.ones((count, size, channels + 1), dtype=np.float32)
+    pixels[..., :-1] = blocks
+    norms = sum(pixels[..., c] ** 2 for c in range(channels))
+
+    # Start from the pixel farthest from the block mean, then repeatedly the one farthest from all picked so far,
+    # of different colors equally far the one PIL's hash table holds first
+    packed = blocks[..., 0].astype(np.int32) << 16 | blocks[..., 1].astype(np.int32) << 8 | blocks[..., 2]
+    totals = mask[:, None].astype(np.float32) @ pixels
+    centroid = np.floor(0.5 + totals[..., :-1] / np.maximum(totals[..., -1:], 1))
+    centroids = np.empty((count, k, channels), dtype=np.float32)
+    for j in range(k):
+        distance = norms + (pixels @ np.concatenate([-2 * centroid, (centroid ** 2).sum(-1, keepdims=True)], -1).transpose(0, 2, 1))[..., 0]
+        distance = np.where(mask, distance, -1)
+        farthest = distance if j < 2 else np.minimum(farthest, distance)
+        pick = farthest.argmax(-1)
+        tied = farthest == farthest.max(-1, keepdims=True)
+        tied = np.nonzero(np.where(tied, packed, -1).max(-1) != np.where(tied, packed, 1 << 24).min(-1))[0]
+        if len(tied):
+            key = hash_order(blocks[tied], mask[tied])
+            pick[tied] = np.where(farthest[tied] == farthest[tied].max(-1, keepdims=True), key, np.iinfo(np.int64).max).argmin(-1)
+        centroid = np.take_along_axis(pixels[..., :-1], pick[:, None, None], 1)
+        centroids[:, j] = centroid[:, 0]
+
+    # Every pixel starts in the first cluster. Move the centroids to the rounded mean of their pixels and reassign
+    # the pixels, only the blocks where at least k pixels changed cluster go on and are kept in smaller arrays
+    labels = nearest_centroid(pixels, centroids, padding, np.zeros(padding.shape, dtype=np.uint8))
+    active, current, moving_pixels, moving_padding = np.arange(count), labels, pixels, padding
+    for _ in range(iterations):
+        sums, sizes = cluster_sums(current, moving_pixels, k)
+        means = np.floor(0.5 + sums / np.maximum(sizes, 1)[..., None]) * (sizes[..., None] > 0)
+        nearest = nearest_centroid(moving_pixels, means, moving_padding, current)
+        moving = (nearest != current).sum(-1) >= k
+        centroids[active], labels[active] = means, nearest
+        if not moving.any():
+            break
+        active, current, moving_pixels, moving_padding = active[moving], nearest[moving], moving_pixels[moving], moving_padding[moving]
+
+    # Clusters that ended up on the same color count as one, the way the colors of the quantized image are counted
+    _, sizes = cluster_sums(labels, pixels, k)
+    centroids = centroids.astype(np.int32)
+    packed = centroids[..., 0] << 16 | centroids[..., 1] << 8 | centroids[..., 2]
+    same = (packed[:, :, None] == packed[:, None, :]).astype(np.float32)
+    return centroids, (same @ sizes[..., None])[..., 0], labels.astype(np.int64)
+
+def most_common(colors, counts):
+    # Index of the color [B, k, C] with the most pixels, ties going to the one PIL's getcolors lists first,
+    # the one in the lowest slot of its hash table, 511 - (R + 256 * (G & 1)) unless two colors want the same slot
+    slot = 511 - (colors[..., 0] + 256 * (colors[..., 1] & 1))
+    return np.where(counts == counts.max(-1, keepdims=True), slot, 512).argmin(-1)
+
+def exact_clusters(blocks, mask):
+    # Clusters of blocks [B, P, C] quantized to as many colors as they have pixels, where every color keeps its own cluster
+    # Returned like kmeans_blocks with one cluster per pixel: its color, how many pixels of the block share it and the
+    # pixel's own index as its cluster, padding pixels count for nothing
+    packed = blocks[..., 0].astype(np.int32) << 16 | blocks[..., 1].astype(np.int32) << 8 | blocks[..., 2]
+    packed = np.where(mask, packed, -1)
+    counts = ((packed[:, :, None] == packed[:, None, :]) & mask[:, None, :]).sum(-1) * mask
+    labels = np.broadcast_to(np.arange(blocks.shape[1]), mask.shape)
+    return blocks.astype(np.int32), counts, labels
+
+def kCentroid(image, width, height, centroids):
+    # Downscale by clustering every block of pixels into a few colors and keeping the color of the largest cluster
+    pixels = np.asarray(image.convert("RGB"))
+    xs, xe = block_bounds(pixels.shape[1], width)
+    ys, ye = block_bounds(pixels.shape[0], height)
+    return centroid_blocks(pixels, xs, xe, ys, ye, centroids)
+
+def centroid_blocks(pixels, xs, xe, ys, ye, centroids):
+    # kCentroid over blocks with the given pixel ranges
+    width, height = len(xs), len(ys)
+    downscaled = np.zeros((height, width, 3), dtype=np.uint8)
+
+    # Work through rows of blocks in chunks so the distance arrays stay small on large images
+    block_pixels = int((xe - xs).max() * (ye - ys).max())
+    rows = max(1, (1 << 20) // (block_pixels * width * max(centroids, 1)))
+    for top in range(0, height, rows):
+        bottom = min(top + rows, height)
+        blocks, mask = block_view(pixels, xs, xe, ys[top:bottom], ye[top:bottom])
+        blocks = blocks.reshape(-1, blocks.shape[2], 3)
+
+        mask = mask.reshape(-1, mask.shape[2])
+        colors, counts, _ = kmeans_blocks(blocks, mask, centroids)
+        color = colors[np.arange(len(colors)), most_common(colors, counts)]
+        downscaled[top:bottom] = color.astype(np.uint8).reshape(bottom - top, width, 3)
+
+    return Image.fromarray(downscaled, mode="RGB")
+
+def strip_palette(image, strip, colors):
+    # Paletted image of one pixel per color from an image of vertical color strips strip pixels wide,
+    # every strip reduced to its most common color. Colors without a whole strip in the image show the first one
+    strips = min(int(image.width / strip), colors)
+    swatches = np.asarray(kCentroid(image, strips, 1, 2))[0]
+    indices = np.arange(colors, dtype=np.uint8)
+    palette = Image.fromarray(np.where(indices < strips, indices, 0).astype(np.uint8)[None], mode="P")
+    palette.putpalette(swatches.flatten().tolist())
+    return palette
+
+def kDenoise(image, smoothing, strength):
+    # Replace pixels whose color is rare in their 3x3 neighbourhood with the most common color there
+    pixels = np.asarray(image.convert("RGB"))
+    height, width = pixels.shape[:2]
+    denoised = np.zeros((height, width, 3), dtype=np.uint8)
+
+    # Neighbourhoods reaching over the top and left edge see black, the ones at the bottom and right edge are cut off
+    padded = np.pad(pixels, ((1, 1), (1, 1), (0, 0)))
+    rowsvalid = np.ones((height, 3), dtype=bool)
+    rowsvalid[-1, 2] = False
+    colsvalid = np.ones((width, 3), dtype=bool)
+    colsvalid[-1, 2] = False
+
+    # Work through rows in chunks so the distance arrays stay small on large images
+    rows = max(1, (1 << 18) // width)
+    for top in range(0, height, rows):
+        bottom = min(top + rows, height)
+        windows = sliding_window_view(padded[top:bottom + 2], (3, 3), axis=(0, 1))
+        windows = windows.transpose(0, 1, 3, 4, 2).reshape(-1, 9, 3)
+        mask = (rowsvalid[top:bottom, None, :, None] & colsvalid[None, :, None, :]).reshape(-1, 9)
+        tiles = mask.sum(-1)
+
+        # Windows of the same size are quantized to the same number of centroids
+        colors = np.zeros((len(windows), 3), dtype=np.uint8)
+        for size in np.unique(tiles):
+            selected = np.nonzero(tiles == size)[0]
+            centroids = max(2, min(round(size*(1/strength)), size))
+            if centroids == size:
+                palette, counts, labels = exact_clusters(windows[selected], mask[selected])
+            else:
+                palette, counts, labels = kmeans_blocks(windows[selected], mask[selected], centroids)
+
+            # Keep the quantized center color unless too few of its neighbours share it, then take the most common color.
+            # Of colors tied for the most pixels the center's own wins, then the one PIL's getcolors lists first,
+            # never one picked by its position in the window
+            rows_selected = np.arange(len(selected))
+            center = labels[:, 4]
+            shared = counts[rows_selected, center]
+            common = np.where(shared == counts.max(-1), center, most_common(palette, counts))
+            final = np.where(shared < 1+round((size*0.8)*(smoothing/10)), common, center)
+            colors[selected] = palette[rows_selected, final]
+        denoised[top:bottom] = colors.reshape(bottom - top, width, 3)
+
+    return Image.fromarray(denoised, mode="RGB")
+
+def color_histogram(image):
+    # Unique colors of an image as float [N, 3] with how many pixels have each of them
+    pixels = np.asarray(image.convert("RGB")).reshape(-1, 3).astype(np.int32)
+    packed, counts = np.unique(pixels[:, 0] << 16 | pixels[:, 1] << 8 | pixels[:, 2], return_counts=True)
+    colors = np.stack([packed >> 16, (packed >> 8) & 255, packed & 255], -1)
+    return colors.astype(np.float64), counts.astype(np.float64)
+
+def nearest_color(colors, norms, centroids, chunk=1 << 16):
+    # Index of and squared distance to the nearest centroid for every color, as |x|² - 2x·c + |c|² in chunks of colors
+    labels = np.empty(len(colors), dtype=np.int64)
+    nearest = np.empty(len(colors))
+    squared = (centroids ** 2).sum(-1)
+    for start in range(0, len(colors), chunk):
+        part = slice(start, start + chunk)
+        distance = norms[part, None] - 2 * colors[part] @ centroids.T + squared
+        labels[part] = distance.argmin(-1)
+        nearest[part] = distance[np.arange(len(distance)), labels[part]]
+    return labels, np.maximum(nearest, 0)
+
+def quantize_distortions(image, max_k):
+    # Distortion, the summed squared distance of every pixel to its palette color, of the image quantized to k = 1 to max_k colors
+    # Measured on the histogram of the image, the palettes come from the same quantizer used for the final image
+    image = image.convert("RGB")
+    colors, counts = color_histogram(image)
+    norms = (colors ** 2).sum(-1)
+
+    for k in range(1, max_k + 1):
+        centroids = np.array(image.quantize(colors=k, method=2, kmeans=k, dither=0).getpalette()[:k * 3], dtype=np.float64).reshape(-1, 3)
+        _, nearest = nearest_color(colors, norms, centroids)
+        distortion = float((nearest * counts).sum())
+        yield distortion
+
+        # Once every color is reproduced exactly all further distortions are zero
+        if distortion == 0:
+            for _ in range(k + 1, max_k + 1):
+                yield 0.0
+            return
+
+def determine_best_k(image, max_k):
+    # Calculate distortion for different values of k
+    distortions = list(quantize_distortions(image, max_k))
+
+    # Calculate the rate of change of distortions
+    rate_of_change = np.diff(distortions) / np.array(distortions[:-1])
+    
+    # Find the elbow point (best k value)
+    if len(rate_of_change) == 0:
+        best_k = 2
+    else:
+        elbow_index = np.argmax(rate_of_change) + 1
+        best_k = elbow_index + 2
+
+    return best_k
+
+def sample_frames(images):
+    # One image of pixels spread evenly over all frames of an animation, about as many as its largest frame has,
+    # so the best number of colors is picked once for the whole animation at the cost of one frame
+    scale = 1 / np.sqrt(len(images))
+    pixels = [np.asarray(image.convert("RGB").resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))), Image.NEAREST)).reshape(-1, 3) for image in images]
+    return Image.fromarray(np.concatenate(pixels)[None], mode="RGB")
+
+def srgb_to_oklab(colors):
+    # Convert 0-255 sRGB colors [..., 3] to OKLab, where euclidean distances follow perceived color differences
+    rgb = np.asarray(colors, dtype=np.float64) / 255
+    linear = np.where(rgb <= 0.04045, rgb / 12.92, ((rgb + 0.055) / 1.055) ** 2.4)
+    lms = linear @ np.array([[0.4122214708, 0.2119034982, 0.0883024619],
+                             [0.5363325363, 0.6806995451, 0.2817188376],
+                             [0.0514459929, 0.1073969566, 0.6299787005]])
+    return np.cbrt(lms) @ np.array([[0.2104542553, 1.9779984951, 0.0259040371],
+                                    [0.7936177850, -2.4285922050, 0.7827717662],
+                                    [-0.0040720468, 0.4505937099, -0.8086757660]])
+
+def oklab_to_srgb(colors):
+    # Convert OKLab colors [..., 3] back to 0-255 sRGB, out of gamut colors are clipped
+    lms = np.asarray(colors, dtype=np.float64) @ np.array([[1.0, 1.0, 1.0],
+                                                           [0.3963377774, -0.1055613458, -0.0894841775],
+                                                           [0.2158037573, -0.0638541728, -1.2914855480]])
+    linear = np.clip((lms ** 3) @ np.array([[4.0767416621, -1.2684380046, -0.0041960863],
+                                           [-3.3077115913, 2.6097574011, -0.7034186147],
+                                           [0.2309699292, -0.3413193965, 1.7076147010]]), 0, 1)
+    rgb = np.where(linear <= 0.0031308, linear * 12.92, 1.055 * linear ** (1 / 2.4) - 0.055)
+    return rgb * 255
+
+def kmeans_oklab(colors, counts, k, iterations=32, seed=0):
+    # Cluster colors [N, 3] in OKLab into k centroids by k-means weighted by counts
+    # k-means++ starts from the most common color and draws every further one with probability growing with its squared distance
+    rng = np.random.default_rng(seed)
+    norms = (colors ** 2).sum(-1)
+    centroids = [colors[counts.argmax()]]
+    nearest = ((colors - centroids[0]) ** 2).sum(-1)
+    for _ in range(1, k):
+        weights = counts * nearest
+        if weights.sum() <= 0:
+            break
+        pick = rng.choice(len(colors), p=weights / weights.sum())
+        centroids.append(colors[pick])
+        nearest = np.minimum(nearest, ((colors - colors[pick]) ** 2).sum(-1))
+    centroids = np.array(centroids)
+
+    # Move every centroid to the weighted mean of its colors until no color changes cluster
+    labels = None
+    for _ in range(iterations):
+        nearest, _ = nearest_color(colors, norms, centroids)
+        if labels is not None and (nearest == labels).all():
+            break
+        labels = nearest
+        weight = np.bincount(labels, counts, len(centroids))
+        sums = np.stack([np.bincount(labels, counts * colors[:, c], len(centroids)) for c in range(3)], -1)
+        centroids = np.where(weight[:, None] > 0, sums / np.maximum(weight, 1)[:, None], centroids)
+    return centroids
+
+def quantize_oklab(image, k, bits=5, iterations=32, seed=0):
+    # Reduce an image to k colors of its own picked by k-means in OKLab, so the palette follows perceived differences
+    # Clustering runs on the histogram of unique colors, merged into bits bits per channel when there are many of them
+    pixels = np.asarray(image.convert("RGB"))
+    flat = pixels.reshape(-1, 3).astype(np.int32)
+    packed, inverse, counts = np.unique(flat[:, 0] << 16 | flat[:, 1] << 8 | flat[:, 2], return_inverse=True, return_counts=True)
+    colors = np.stack([packed >> 16, (packed >> 8) & 255, packed & 255], -1)
+    counts = counts.astype(np.float64)
+
+    # Images that already have few enough colors are kept as they are
+    if len(colors) <= k:
+        return image.convert("RGB")
+
+    lab = srgb_to_oklab(colors)
+    samples, weights = lab, counts
+    if len(colors) > 1 << (3 * bits):
+        # Merge colors falling into the same bin into their weighted mean, few thousand bins cluster much faster than every color
+        shift = 8 - bits
+        bins = (colors[:, 0] >> shift) << (2 * bits) | (colors[:, 1] >> shift) << bits | colors[:, 2] >> shift
+        bins, members = np.unique(bins, return_inverse=True)
+        weights = np.bincount(members, counts, len(bins))
+        samples = np.stack([np.bincount(members, counts * lab[:, c], len(bins)) for c in range(3)], -1) / weights[:, None]
+
+    # Round the centroids to colors and map every color to the nearest of them
+    palette = np.clip(np.floor(0.5 + oklab_to_srgb(kmeans_oklab(samples, weights, k, iterations, seed))), 0, 255)
+    labels, _ = nearest_color(lab, (lab ** 2).sum(-1), srgb_to_oklab(palette))
+    return Image.fromarray(palette.astype(np.uint8)[labels][inverse.reshape(-1)].reshape(pixels.shape), mode="RGB")
+
+def nearest_two(colors, centroids, chunk=1 << 16):
+    # Index of the nearest centroid and the distances to the nearest and second nearest centroid for every color
+    labels = np.empty(len(colors), dtype=np.int64)
+    nearest = np.full((len(colors), 2), np.inf)
+    squared = (centroids ** 2).sum(-1)
+    norms = (colors ** 2).sum(-1)
+    for start in range(0, len(colors), chunk):
+        part = slice(start, start + chunk)
+        distance = np.maximum(norms[part, None] - 2 * colors[part] @ centroids.T + squared, 0)
+        labels[part] = distance.argmin(-1)
+        count = min(2, distance.shape[1])
+        nearest[part, :count] = np.sort(np.partition(distance, count - 1, -1)[:, :count], -1)
+    return labels, np.sqrt(nearest[:, 0]), np.sqrt(nearest[:, 1])
+
+def nearest_palette(values, colors):
+    # Index of the nearest palette color by euclidean distance for float [..., 3] values, the first of equally near colors wins
+    best = np.full(values.shape[:-1], np.inf)
+    indices = np.zeros(values.shape[:-1], dtype=np.int64)
+    for i, color in enumerate(colors):
+        difference = values - color
+        distance = np.sqrt(difference[..., 0] ** 2 + difference[..., 1] ** 2 + difference[..., 2] ** 2)
+        closer = distance < best
+        np.copyto(best, distance, where=closer)
+        indices[closer] = i
+    return indices
+
+def palette_lut(palette, bits=6, space="rgb"):
+    # Table of the nearest palette index for every color with bits bits per channel, indexed [r >> s, g >> s, b >> s]
+    # Built once per palette and kept in palette_cache, space is "rgb" or the perceptual "oklab"
+    # Cells where another palette color may be nearer to part of the cell hold len(palette) and are searched exactly
+    palette = np.ascontiguousarray(palette, dtype=np.uint8).reshape(-1, 3)
+    key = (hashlib.sha1(palette.tobytes()).hexdigest(), bits, space)
+    if key in palette_cache:
+        palette_cache.move_to_end(key)
+        return palette_cache[key]
+
+    # Every cell of the table maps to the palette color nearest to its center
+    size = 1 << bits
+    step = 256 / size
+    levels = np.arange(size) * step + (step - 1) / 2
+    cells = np.stack(np.meshgrid(levels, levels, levels, indexing="ij"), -1).reshape(-1, 3)
+    targets = palette.astype(np.float64)
+    corners = cells[:, None] + np.array(list(product((-1, 1), repeat=3))) * (step - 1) / 2
+    if space == "oklab":
+        cells, targets, corners = srgb_to_oklab(cells), srgb_to_oklab(targets), srgb_to_oklab(corners)
+    labels, first, second = nearest_two(cells, targets)
+
+    # No color of a cell is further than radius from its center, so the nearest palette color can only change
+    # inside the cell when the second nearest is within twice that of the nearest. Oklab is not linear in sRGB,
+    # its radius measured at the corners gets some slack
+    radius = np.sqrt(((corners - cells[:, None]) ** 2).sum(-1).max(-1))
+    if space == "oklab":
+        radius *= 1.25
+    labels[second - first <= 2 * radius] = len(palette)
+    lut = labels.astype(np.uint8 if len(palette) < 256 else np.int32).reshape(size, size, size)
+
+    palette_cache[key] = lut
+    while len(palette_cache) > palette_cache_size:
+        palette_cache.popitem(last=False)
+    return lut
+
+def palette_indices(image, palette, bits=6, space="rgb"):
+    # Palette index of every pixel of an image [H, W], one gather from the lookup table of the palette
+    # and the same exact search as bayer_dither over the distinct colors of the pixels that fall in ambiguous cells
+    pixels = np.asarray(image.convert("RGB"))
+    palette = np.ascontiguousarray(palette, dtype=np.uint8).reshape(-1, 3)
+    lut = palette_lut(palette, bits, space)
+    shift = 8 - bits
+    indices = lut[pixels[..., 0] >> shift, pixels[..., 1] >> shift, pixels[..., 2] >> shift]
+    ambiguous = indices == len(palette)
+    if ambiguous.any():
+        colors = pixels[ambiguous].astype(np.int32)
+        unique, inverse = np.unique(colors[:, 0] << 16 | colors[:, 1] << 8 | colors[:, 2], return_inverse=True)
+        colors = np.stack([unique >> 16, (unique >> 8) & 255, unique & 255], -1).astype(np.float64)
+        targets = palette.astype(np.float64)
+        if space == "oklab":
+            colors, targets = srgb_to_oklab(colors), srgb_to_oklab(targets)
+        indices[ambiguous] = nearest_palette(colors, targets)[inverse]
+    return indices
+
+def map_palette(image, palette, bits=6, space="rgb"):
+    # Replace every pixel of an image with the nearest color of a fixed palette [N, 3]
+    palette = np.asarray(palette, dtype=np.uint8).reshape(-1, 3)
+    return Image.fromarray(palette[palette_indices(image, palette, bits, space)], mode="RGB")
+
+def adjust_gamma(image, gamma=1.0):
+    # Create a lookup table for the gamma function
+    gamma_map = [255 * ((i / 255.0) ** (1.0 / gamma)) for i in range(256)]
+    gamma_table = bytes([(int(x / 255.0 * 65535.0) >> 8) for x in gamma_map] * 3)
+
+    # Apply the gamma correction using the lookup table
+    return image.point(gamma_table)
+
+def bayer_matrix(order):
+    # Ordered dithering index matrix of side order, built recursively for powers of two the way hitherdither does
+    # Other orders rank the entries of the next larger power of two matrix cropped to size
+    if order & (order - 1):
+        size = 1 << (order - 1).bit_length()
+        cropped = bayer_matrix(size)[:order, :order]
+        return np.argsort(np.argsort(cropped, axis=None)).reshape(order, order)
+    if order <= 2:
+        return np.array([[0, 2], [3, 1]])
+    smaller = 4 * bayer_matrix(order >> 1)
+    return np.block([[smaller, smaller + 2], [smaller + 3, smaller + 1]])
+
+def bayer_dither(image, palette, threshold, order=8):
+    # Offset every pixel by its entry of the tiled Bayer matrix scaled by threshold, then map it to the nearest palette color
+    # threshold is one value or one per channel, and is wrapped to a byte like hitherdither's threshold array
+    palette = np.asarray(palette, dtype=np.uint8).reshape(-1, 3)
+    pixels = np.asarray(image.convert("RGB")).astype(np.float64)
+    height, width = pixels.shape[:2]
+
+    matrix = (1 + bayer_matrix(order)) / (1 + order * order)
+    tiled = np.tile(matrix, (height // order + 1, width // order + 1))[:height, :width]
+    offset = tiled[..., None] * (np.broadcast_to(threshold, 3).astype(np.int64) % 256)
+    pixels += offset
+
+    return Image.fromarray(palette[nearest_palette(pixels, palette.astype(np.float64))], mode="RGB")
+
+# Error diffusion kernels as (dx, dy, weight) offsets from the current pixel
+DIFFUSION_KERNELS = {
+    "floyd": [(1, 0, 7/16), (-1, 1, 3/16), (0, 1, 5/16), (1, 1, 1/16)],
+    "atkinson": [(1, 0, 1/8), (2, 0, 1/8), (-1, 1, 1/8), (0, 1, 1/8), (1, 1, 1/8), (0, 2, 1/8)],
+    "sierra": [(1, 0, 5/32), (2, 0, 3/32), (-2, 1, 2/32), (-1, 1, 4/32), (0, 1, 5/32), (1, 1, 4/32), (2, 1, 2/32), (-1, 2, 2/32), (0, 2, 3/32), (1, 2, 2/32)],
+}
+
+def diffusion_dither(image, palette, kernel="floyd", amount=1.0):
+    # Map every pixel to its nearest palette color and spread the error over the pixels after it, scaled by amount
+    # Pixels on one wavefront x + slope*y only receive error from earlier wavefronts, so each of them is handled in one step
+    palette = np.asarray(palette, dtype=np.uint8).reshape(-1, 3)
+    colors = palette.astype(np.float32)
+    squared = (colors ** 2).sum(-1)
+    offsets = DIFFUSION_KERNELS[kernel]
+    pixels = np.asarray(image.convert("RGB")).astype(np.float32)
+    height, width = pixels.shape[:2]
+
+    # Errors are kept in a flat array with margins above and beside the image, every pixel gathers the error it receives
+    # from the pixels before it in one step
+    reach = max(max(abs(dx), dy) for dx, dy, _ in offsets)
+    slope = max(1 - dx // dy for dx, dy, _ in offsets if dy > 0)
+    stride = width + 2 * reach
+    errors = np.zeros(((height + reach) * stride, 3), dtype=np.float32)
+    sources = np.array([-(dy * stride + dx) for dx, dy, _ in offsets])
+    weights = np.array([weight for _, _, weight in offsets], dtype=np.float32) * amount
+
+    indices = np.zeros((height, width), dtype=np.int64)
+    rows = np.arange(height)
+    for step in range(width + slope * (height - 1)):
+        # Pixels of this wavefront, from the first row whose column is still inside the image
+        first = max(0, (step - width) // slope + 1)
+        y = rows[first:min(height, step // slope + 1)]
+        x = step - slope * y
+        position = (y + reach) * stride + x + reach
+
+        # Nearest palette color of every pixel with the error it received
+        value = pixels[y, x] + weights @ errors[position[:, None] + sources]
+        value = np.clip(value, 0, 255)
+        nearest = (squared - 2 * value @ colors.T).argmin(-1)
+        indices[y, x] = nearest
+        errors[position] = value - colors[nearest]
+
+    return Image.fromarray(palette[indices], mode="RGB")
+
+def palettize_frame(image, palette, colors, dithering, strength, denoise, smoothness, intensity, space="rgb", quantizer="pil"):
+    # Reduce one image to a fixed palette, or to a number of colors of its own where colors None picks the best number
+    # Colors of its own are picked by PIL's k-means in RGB, or with quantizer "oklab" by quantize_oklab
+    # Only depends on its arguments, so frames can be handed to worker processes
+    img = image.convert('RGB')
+
+    # Apply denoising if enabled
+    if denoise == "true":
+        img = kDenoise(img, smoothness, intensity)
+
+    # Dithering is either the order of a Bayer matrix or the name of an error diffusion kernel
+    diffuse = dithering in DIFFUSION_KERNELS
+    dither = strength > 0 and (diffuse or dithering > 0)
+
+    # Calculate the threshold for dithering
+    threshold = 4*strength
+
+    if palette is not None:
+        if not dither:
+            # Map every pixel to its nearest palette color through the palette's cached lookup table
+            return map_palette(img, palette, space=space)
+        gamma = 1.0-(0.02*strength)
+    else:
+        if colors is None:
+            colors = determine_best_k(img, 64)
+        if colors <= 0:
+            return img
+
+        # Perform quantization, the colors it picks are the palette to dither with
+        if quantizer == "oklab":
+            img_indexed = quantize_oklab(img, colors)
+        else:
+            img_indexed = img.quantize(colors=colors, method=1, kmeans=colors, dither=0).convert('RGB')
+        if not dither:
+            return img_indexed
+        palette = [color for _, color in img_indexed.getcolors(16777216)]
+        gamma = 1.0-(0.03*strength)
+
+    if diffuse:
+        # Spread the quantization error over the following pixels, strength 10 spreads all of it
+        return diffusion_dither(img, palette, dithering, min(strength/10, 1))
+
+    # Perform ordered dithering using Bayer matrix on the gamma adjusted image
+    return bayer_dither(adjust_gamma(img, gamma), palette, threshold, order=dithering)
+
+def edge_profiles(image, samples=256):
+    # Color difference between neighbouring columns summed down the image, and between neighbouring rows summed across it
+    # Grid lines run through the whole image, so a few hundred evenly spaced rows and columns are enough to find them
+    # Nearest neighbour resizing picks them out without converting the whole image
+    width, height = image.size
+    rows = np.asarray(image.resize((width, min(height, samples)), Image.NEAREST).convert("RGB"), dtype=np.float32)
+    columns = np.asarray(image.resize((min(width, samples), height), Image.NEAREST).convert("RGB"), dtype=np.float32)
+    horizontal = np.sqrt(((rows[:, 1:] - rows[:, :-1]) ** 2).sum(-1)).sum(0)
+    vertical = np.sqrt(((columns[1:] - columns[:-1]) ** 2).sum(-1)).sum(1)
+    return horizontal, vertical
+
+def strongest_edges(profile, start, end, strongest):
+    # Profile indices of the strongest edges between start and end with their share of the energy among them
+    edges = np.nonzero(profile[start:end])[0] + start
+    edges = np.sort(edges[np.argsort(-profile[edges], kind="stable")[:strongest]])
+    return edges, profile[edges] / profile[edges].sum()
+
+def lattice_coverage(positions, weights, periods, bins=8):
+    # Largest weighted share of positions that one lattice catches for every period in periods
+    # Rounding puts the positions of a grid within half a pixel of its lattice, and resizers round exact halves either way,
+    # so a lattice catches what lies within one pixel and one bin. Windows slide over a histogram of the phases in
+    # 1/bins pixel bins, laid out one period after another with the first bins of each repeated after its end
+    counts = np.ceil(periods * bins).astype(np.int64)
+    reach = bins + 1
+    widths = counts + reach
+    starts = np.cumsum(widths) - widths
+    phases = (positions.astype(np.float32)[None] % periods.astype(np.float32)[:, None] * bins).astype(np.int64) + starts[:, None]
+    histogram = np.bincount(phases.ravel(), np.broadcast_to(weights, phases.shape).ravel(), widths.sum())
+    wrap = np.arange(reach)
+    histogram[(starts + counts)[:, None] + wrap] = histogram[starts[:, None] + wrap]
+
+    # Windows starting after the first repeated bin reach into the next period and are left out
+    total = np.cumsum(histogram)
+    windows = total[reach - 1:] - np.concatenate([[0], total[:-reach]])
+    windows[(starts + counts + 1)[:-1, None] + wrap[:-1]] = -1
+    return np.maximum.reduceat(windows, starts)
+
+def lattice_fit(positions, weights, periods, span, ratio):
+    # Period and offset of the lattice of the largest period in periods that catches nearly as many positions as the best one,
+    # of the periods within two pixels of drift over span from it the one the positions line up on closest
+    coverage = lattice_coverage(positions, weights, periods)
+    good = coverage >= ratio * coverage.max()
+    largest = periods[good][-1]
+    close = periods[good & (periods >= largest * (1 - 2 / span))]
+    component = np.exp(2j * np.pi * positions[None] / close[:, None]) @ weights
+    best = np.abs(component).argmax()
+    return close[best], np.angle(component[best]) / (2 * np.pi) * close[best] % close[best], coverage.max()
+
+def chance_tail(count, hits, chance):
+    # Probability of at least hits of count positions landing on a lattice that covers chance of all positions at random
+    if hits <= 0 or chance >= 1:
+        return 1.0
+    if chance <= 0:
+        return 0.0
+    return sum(exp(lgamma(count + 1) - lgamma(i + 1) - lgamma(count - i + 1) + i * log(chance) + (count - i) * log(1 - chance))
+               for i in range(hits, count + 1))
+
+def grid_period(profile, max_period=64, window=256, strongest=64, ratio=0.95, significance=0.01):
+    # Period, offset of the first block and confidence of the pixel grid along one axis from its edge profile
+    # Every edge of upscaled pixel art starts a block, so the edges lie on a lattice of rounded multiples of the period.
+    # Flat areas leave most of the lattice without edges, and spectra or autocorrelations of such sparse edges are led astray
+    # by lattices of multiples of the period and by the spread of the edges, so lattices are tried directly: the period is
+    # the largest one catching nearly as many edges as the best. A period as likely to catch the edges by chance, or one that
+    # doesn't hold over the whole profile, is no grid, a period of 1. The confidence is the share of edge energy on the
+    # lattice beyond what as many positions anywhere would hold
+    high = min(max_period, len(profile) / 2)
+    if high <= 1.5 or profile.sum() <= 0:
+        return 1.0, 0.0, 0.0
+
+    # The window of the profile with the most edge energy first, on its short span few periods need to be tried
+    window = min(window, len(profile))
+    total = np.concatenate([[0], np.cumsum(profile)])
+    start = int((total[window:] - total[:len(total) - window]).argmax())
+    edges, weights = strongest_edges(profile, start, start + window, strongest)
+    span = max(edges[-1] - edges[0], 1)
+    periods = np.exp(np.arange(np.log(1.5), np.log(high), 0.1 / span))
+    period, _, caught = lattice_fit(edges + 1.0, weights, periods, span, ratio)
+
+    # Then on the strongest edges of the whole profile close to that period, which has to catch as many of them
+    edges, weights = strongest_edges(profile, 0, len(profile), strongest)
+    whole = max(edges[-1] - edges[0], 1)
+    periods = period * np.exp(np.arange(-2 / span, 2 / span, 0.1 / whole))
+    period, offset, covered = lattice_fit(edges + 1.0, weights, periods, whole, ratio)
+    if covered < ratio * caught:
+        return 1.0, 0.0, 0.0
+
+    # Chance of as many edges on the lattice, over about as many lattices as there are to try
+    distance = (np.arange(1, len(profile) + 1) - offset) % period
+    near = np.minimum(distance, period - distance) <= 0.5 + 1 / 16
+    chance = near.mean()
+    if chance_tail(len(edges), int(near[edges].sum()), chance) * whole * np.log(high / 1.5) > significance:
+        return 1.0, 0.0, 0.0
+    share = profile[near].sum() / profile.sum()
+    return period, offset, max(0.0, float(share - chance) / (1 - chance))
+
+def sample_blocks(starts, ends, samples):
+    # Up to samples evenly spread positions inside every block, with the ranges the blocks cover among the positions
+    counts = np.minimum(ends - starts, samples)
+    block = np.repeat(np.arange(len(starts)), counts)
+    first = np.cumsum(counts) - counts
+    index = np.arange(counts.sum()) - first[block]
+    positions = starts[block] + ((ends - starts)[block] * (index + 0.5) / counts[block]).astype(np.int64)
+    return positions, first, first + counts
+
+def grid_bounds(size, period, offset):
+    # Pixel ranges of the blocks of a grid, blocks cut off at the image edges are kept when more than half of them is visible
+    starts = np.round(np.arange(offset - period, size, period)).astype(np.int64)
+    starts = starts[(starts > 0) & (starts < size)]
+    if len(starts) and starts[0] <= period / 2:
+        starts = starts[1:]
+    if len(starts) and size - starts[-1] <= period / 2:
+        starts = starts[:-1]
+    starts = np.concatenate([[0], starts])
+    return starts, np.append(starts[1:], size)
+
+def detect_grid(image, max_period=64, threshold=0.25):
+    # Pixel grid of upscaled pixel art as (period, offset) per axis, with the confidence of the weaker axis
+    # Axes without a grid found with at least threshold confidence keep every pixel, a period of 1
+    grids = []
+    confidence = 1.0
+    for profile in edge_profiles(image):
+        period, offset, certainty = grid_period(profile, max_period)
+        grids.append((period, offset) if certainty >= threshold else (1.0, 0.0))
+        confidence = min(confidence, certainty)
+    return grids[0], grids[1], confidence
+
+def grid_downscale(image, x, y, centroids=2, samples=4):
+    # Downscale to one pixel per block of a detected grid
+    # Blocks are clustered from up to samples by samples pixels spread over their inside, away from blurred block edges
+    pixels = np.asarray(image.convert("RGB"))
+    xs, xe = grid_bounds(pixels.shape[1], *x)
+    ys, ye = grid_bounds(pixels.shape[0], *y)
+    columns, xs, xe = sample_blocks(xs, xe, samples)
+    rows, ys, ye = sample_blocks(ys, ye, samples)
+    return centroid_blocks(pixels[rows][:, columns], xs, xe, ys, ye, centroids)
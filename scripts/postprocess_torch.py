@@ -0,0 +1,321 @@
+import numpy as np
+import torch
+from PIL import Image
+from postprocess import table_size, block_bounds, grid_bounds, sample_blocks, bayer_matrix, determine_best_k, quantize_oklab, diffusion_dither, DIFFUSION_KERNELS
+
+# Tensor versions of the post-processing in postprocess.py, working on uint8 [H, W, 3] tensors on any device
+# Decoded samples can be processed where they are and only the final, usually much smaller, image copied to the host
+# On the CPU torch spreads the work of every operation over its intra-op threads
+# determine_best_k, adaptive palettes and error diffusion are built on PIL's quantizer and have no tensor version
+
+def to_tensor(image, device="cpu"):
+    return torch.from_numpy(np.array(image.convert("RGB"))).to(device)
+
+def to_image(pixels):
+    return Image.fromarray(pixels.cpu().numpy(), mode="RGB")
+
+def float_dtype(device):
+    # Double precision where it is cheap gives the same results as the NumPy versions
+    return torch.float64 if torch.device(device).type == "cpu" else torch.float32
+
+def block_view(pixels, xs, xe, ys, ye):
+    # Gather the blocks with the given pixel ranges of an [H, W, C] tensor into [rows, columns, bh*bw, C], with a mask of the valid pixels
+    # Blocks of non-integer scale factors differ in size and are padded to the largest one
+    device = pixels.device
+    xs, xe, ys, ye = (torch.as_tensor(bound, device=device) for bound in (xs, xe, ys, ye))
+    bw, bh = int((xe - xs).max()), int((ye - ys).max())
+
+    xi = xs[:, None] + torch.arange(bw, device=device)
+    yi = ys[:, None] + torch.arange(bh, device=device)
+    xvalid = xi < xe[:, None]
+    yvalid = yi < ye[:, None]
+    xi = xi.clamp(max=pixels.shape[1] - 1)
+    yi = yi.clamp(max=pixels.shape[0] - 1)
+
+    blocks = pixels[yi[:, :, None, None], xi[None, None, :, :]]
+    blocks = blocks.permute(0, 2, 1, 3, 4).reshape(len(ys), len(xs), bh * bw, -1)
+    mask = (yvalid[:, None, :, None] & xvalid[None, :, None, :]).reshape(len(ys), len(xs), bh * bw)
+    return blocks, mask
+
+def hash_order(blocks, mask):
+    # Same sort key of PIL's hash table order as postprocess.hash_order
+    r, g, b = (blocks[..., c].to(torch.int64) for c in range(3))
+    bucket = ((r * 463) ^ ((g << 8) * 10069) ^ ((b << 16) * 64997)) & 0xFFFFFFFF
+
+    length = torch.full((len(mask),), 11, dtype=torch.int64, device=blocks.device)
+    if mask.shape[1] > 33:
+        packed = torch.where(mask, r << 16 | g << 8 | b, -1).sort(-1).values
+        unique = 1 + (packed[:, 1:] != packed[:, :-1]).sum(-1) - (~mask).any(-1).to(torch.int64)
+        sizes = [11]
+        while sizes[-1] * 3 < int(unique.max()):
+            sizes.append(table_size(2 * sizes[-1] + 1))
+        sizes = torch.tensor(sizes, device=blocks.device)
+        length = sizes[torch.searchsorted(sizes * 3, unique)]
+    return (bucket % length[:, None]) << 24 | r << 16 | g << 8 | b
+
+def nearest_centroid(pixels, centroids, padding, current):
+    # Same nearest centroids as postprocess.nearest_centroid, pixels [B, P, C + 1] end in a column of ones
+    k = centroids.shape[1]
+    scores = pixels @ torch.cat([centroids, -0.5 * (centroids ** 2).sum(-1, keepdim=True)], -1).transpose(1, 2)
+    labels = torch.zeros(padding.shape, dtype=torch.uint8, device=pixels.device)
+    best = scores[..., 0]
+    for j in range(1, k):
+        labels += (scores[..., j] > best).to(torch.uint8) * (j - labels)
+        best = torch.maximum(best, scores[..., j])
+    ties = sum((scores[..., j] == best).to(torch.uint8) for j in range(k))
+    current = current.clamp(max=k - 1)
+    kept = sum(scores[..., j] * (current == j) for j in range(k)) >= best
+    labels = torch.where(kept, current, labels)
+
+    # Of several equally near centroids the one closest to the current centroid wins
+    b, p = torch.nonzero((ties > 1) & ~kept, as_tuple=True)
+    if len(b):
+        between = ((centroids[b] - centroids[b, current[b, p].long()][:, None]) ** 2).sum(-1)
+        key = torch.where(scores[b, p] == best[b, p, None], between * k + torch.arange(k, device=pixels.device), float("inf"))
+        labels[b, p] = key.argmin(-1).to(torch.uint8)
+    return labels | padding
+
+def cluster_sums(labels, pixels, k):
+    # Summed colors [B, k, C] and sizes [B, k] of the clusters
+    sums = (labels[:, None] == torch.arange(k, dtype=torch.uint8, device=labels.device)[:, None]).to(pixels.dtype) @ pixels
+    return sums[..., :-1], sums[..., -1]
+
+def kmeans_blocks(blocks, mask, k, iterations=256):
+    # Same clustering as postprocess.kmeans_blocks: integer centroids [B, k, C], cluster sizes [B, k] and labels [B, P]
+    device = blocks.device
+    dtype = float_dtype(device)
+    count, size, channels = blocks.shape
+    padding = torch.where(mask, 0, 255).to(torch.uint8)
+
+    # Pixels followed by a one [B, P, C + 1]
+    pixels = torch.ones((count, size, channels + 1), dtype=dtype, device=device)
+    pixels[..., :-1] = blocks
+    norms = sum(pixels[..., c] ** 2 for c in range(channels))
+
+    # Start from the pixel farthest from the block mean, then repeatedly the one farthest from all picked so far,
+    # of different colors equally far the one PIL's hash table holds first
+    packed = blocks[..., 0].to(torch.int32) << 16 | blocks[..., 1].to(torch.int32) << 8 | blocks[..., 2].to(torch.int32)
+    totals = mask[:, None].to(dtype) @ pixels
+    centroid = torch.floor(0.5 + totals[..., :-1] / totals[..., -1:].clamp(min=1))
+    centroids = torch.empty((count, k, channels), dtype=dtype, device=device)
+    for j in range(k):
+        distance = norms + (pixels @ torch.cat([-2 * centroid, (centroid ** 2).sum(-1, keepdim=True)], -1).transpose(1, 2))[..., 0]
+        distance = torch.where(mask, distance, -1)
+        farthest = distance if j < 2 else torch.minimum(farthest, distance)
+        pick = farthest.argmax(-1)
+        tied = farthest == farthest.max(-1, keepdim=True).values
+        tied = torch.nonzero(torch.where(tied, packed, -1).max(-1).values != torch.where(tied, packed, 1 << 24).min(-1).values)[:, 0]
+        if len(tied):
+            key = hash_order(blocks[tied], mask[tied])
+            top = farthest[tied] == farthest[tied].max(-1, keepdim=True).values
+            pick[tied] = torch.where(top, key, torch.iinfo(torch.int64).max).argmin(-1)
+        centroid = pixels[..., :-1].gather(1, pick[:, None, None].expand(-1, 1, channels))
+        centroids[:, j] = centroid[:, 0]
+
+    # Every pixel starts in the first cluster, blocks go on while at least k of their pixels change cluster
+    labels = nearest_centroid(pixels, centroids, padding, torch.zeros(padding.shape, dtype=torch.uint8, device=device))
+    active, current, moving_pixels, moving_padding = torch.arange(count, device=device), labels, pixels, padding
+    for _ in range(iterations):
+        sums, sizes = cluster_sums(current, moving_pixels, k)
+        means = torch.floor(0.5 + sums / sizes.clamp(min=1)[..., None]) * (sizes[..., None] > 0)
+        nearest = nearest_centroid(moving_pixels, means, moving_padding, current)
+        moving = (nearest != current).sum(-1) >= k
+        centroids[active], labels[active] = means, nearest
+        if not moving.any():
+            break
+        active, current, moving_pixels, moving_padding = active[moving], nearest[moving], moving_pixels[moving], moving_padding[moving]
+
+    # Clusters that ended up on the same color count as one
+    _, sizes = cluster_sums(labels, pixels, k)
+    centroids = centroids.to(torch.int32)
+    packed = centroids[..., 0] << 16 | centroids[..., 1] << 8 | centroids[..., 2]
+    same = (packed[:, :, None] == packed[:, None, :]).to(dtype)
+    return centroids, (same @ sizes[..., None])[..., 0], labels.to(torch.int64)
+
+def most_common(colors, counts):
+    # Same choice of the color with the most pixels as postprocess.most_common
+    slot = 511 - (colors[..., 0] + 256 * (colors[..., 1] & 1))
+    return torch.where(counts == counts.max(-1, keepdim=True).values, slot, 512).argmin(-1)
+
+def exact_clusters(blocks, mask):
+    # Same clusters of blocks quantized to as many colors as they have pixels as postprocess.exact_clusters
+    blocks = blocks.to(torch.int32)
+    packed = torch.where(mask, blocks[..., 0] << 16 | blocks[..., 1] << 8 | blocks[..., 2], -1)
+    counts = ((packed[:, :, None] == packed[:, None, :]) & mask[:, None, :]).sum(-1) * mask
+    labels = torch.arange(blocks.shape[1], device=blocks.device).expand(mask.shape)
+    return blocks, counts, labels
+
+def centroid_blocks(pixels, xs, xe, ys, ye, centroids):
+    # kCentroid over blocks with the given pixel ranges
+    width, height = len(xs), len(ys)
+    downscaled = torch.zeros((height, width, 3), dtype=torch.uint8, device=pixels.device)
+
+    # Work through rows of blocks in chunks so the distance tensors stay small on large images
+    block_pixels = int((xe - xs).max() * (ye - ys).max())
+    rows = max(1, (1 << 20) // (block_pixels * width * max(centroids, 1)))
+    for top in range(0, height, rows):
+        bottom = min(top + rows, height)
+        blocks, mask = block_view(pixels, xs, xe, ys[top:bottom], ye[top:bottom])
+        blocks = blocks.reshape(-1, blocks.shape[2], 3)
+
+        mask = mask.reshape(-1, mask.shape[2])
+        colors, counts, _ = kmeans_blocks(blocks, mask, centroids)
+        color = colors[torch.arange(len(colors), device=pixels.device), most_common(colors, counts)]
+        downscaled[top:bottom] = color.to(torch.uint8).reshape(bottom - top, width, 3)
+
+    return downscaled
+
+def kCentroid(pixels, width, height, centroids):
+    # Downscale by clustering every block of pixels into a few colors and keeping the color of the largest cluster
+    xs, xe = block_bounds(pixels.shape[1], width)
+    ys, ye = block_bounds(pixels.shape[0], height)
+    return centroid_blocks(pixels, xs, xe, ys, ye, centroids)
+
+def grid_downscale(pixels, x, y, centroids=2, samples=4):
+    # Downscale to one pixel per block of a grid found by postprocess.detect_grid
+    xs, xe = grid_bounds(pixels.shape[1], *x)
+    ys, ye = grid_bounds(pixels.shape[0], *y)
+    columns, xs, xe = sample_blocks(xs, xe, samples)
+    rows, ys, ye = sample_blocks(ys, ye, samples)
+    device = pixels.device
+    pixels = pixels[torch.as_tensor(rows, device=device)][:, torch.as_tensor(columns, device=device)]
+    return centroid_blocks(pixels, xs, xe, ys, ye, centroids)
+
+def kDenoise(pixels, smoothing, strength):
+    # Replace pixels whose color is rare in their 3x3 neighbourhood with the most common color there
+    height, width = pixels.shape[:2]
+    device = pixels.device
+    denoised = torch.zeros((height, width, 3), dtype=torch.uint8, device=device)
+
+    # Neighbourhoods reaching over the top and left edge see black, the ones at the bottom and right edge are cut off
+    padded = torch.nn.functional.pad(pixels, (0, 0, 1, 1, 1, 1))
+    rowsvalid = torch.ones((height, 3), dtype=torch.bool, device=device)
+    rowsvalid[-1, 2] = False
+    colsvalid = torch.ones((width, 3), dtype=torch.bool, device=device)
+    colsvalid[-1, 2] = False
+
+    # Work through rows in chunks so the distance tensors stay small on large images
+    rows = max(1, (1 << 18) // width)
+    for top in range(0, height, rows):
+        bottom = min(top + rows, height)
+        windows = padded[top:bottom + 2].unfold(0, 3, 1).unfold(1, 3, 1)
+        windows = windows.permute(0, 1, 3, 4, 2).reshape(-1, 9, 3)
+        mask = (rowsvalid[top:bottom, None, :, None] & colsvalid[None, :, None, :]).reshape(-1, 9)
+        tiles = mask.sum(-1)
+
+        # Windows of the same size are quantized to the same number of centroids
+        colors = torch.zeros((len(windows), 3), dtype=torch.uint8, device=device)
+        for size in tiles.unique().tolist():
+            selected = torch.nonzero(tiles == size)[:, 0]
+            centroids = max(2, min(round(size*(1/strength)), size))
+            if centroids == size:
+                palette, counts, labels = exact_clusters(windows[selected], mask[selected])
+            else:
+                palette, counts, labels = kmeans_blocks(windows[selected], mask[selected], centroids)
+
+            # Keep the quantized center color unless too few of its neighbours share it, then take the most common color.
+            # Of colors tied for the most pixels the center's own wins, then the one PIL's getcolors lists first,
+            # never one picked by its position in the window
+            rows_selected = torch.arange(len(selected), device=device)
+            center = labels[:, 4]
+            shared = counts[rows_selected, center]
+            common = torch.where(shared == counts.max(-1).values, center, most_common(palette, counts))
+            final = torch.where(shared < 1+round((size*0.8)*(smoothing/10)), common, center)
+            colors[selected] = palette[rows_selected, final].to(torch.uint8)
+        denoised[top:bottom] = colors.reshape(bottom - top, width, 3)
+
+    return denoised
+
+def adjust_gamma(pixels, gamma=1.0):
+    # Same lookup table as postprocess.adjust_gamma, applied with one gather
+    gamma_map = [255 * ((i / 255.0) ** (1.0 / gamma)) for i in range(256)]
+    gamma_table = torch.tensor([(int(x / 255.0 * 65535.0) >> 8) for x in gamma_map], dtype=torch.uint8, device=pixels.device)
+    return gamma_table[pixels.long()]
+
+def srgb_to_oklab(colors):
+    # Convert 0-255 sRGB colors [..., 3] to OKLab
+    rgb = colors / 255
+    linear = torch.where(rgb <= 0.04045, rgb / 12.92, ((rgb + 0.055) / 1.055) ** 2.4)
+    lms = linear @ torch.tensor([[0.4122214708, 0.2119034982, 0.0883024619],
+                                 [0.5363325363, 0.6806995451, 0.2817188376],
+                                 [0.0514459929, 0.1073969566, 0.6299787005]], dtype=colors.dtype, device=colors.device)
+    return lms.sign() * lms.abs() ** (1 / 3) @ torch.tensor([[0.2104542553, 1.9779984951, 0.0259040371],
+                                                              [0.7936177850, -2.4285922050, 0.7827717662],
+                                                              [-0.0040720468, 0.4505937099, -0.8086757660]], dtype=colors.dtype, device=colors.device)
+
+def nearest_palette(values, colors):
+    # Same search as postprocess.nearest_palette for float [H, W, 3] values, the first of equally near colors wins
+    best = torch.full(values.shape[:2], float("inf"), dtype=values.dtype, device=values.device)
+    indices = torch.zeros(values.shape[:2], dtype=torch.int64, device=values.device)
+    for i, color in enumerate(colors):
+        difference = values - color
+        distance = torch.sqrt(difference[..., 0] ** 2 + difference[..., 1] ** 2 + difference[..., 2] ** 2)
+        closer = distance < best
+        best = torch.where(closer, distance, best)
+        indices[closer] = i
+    return indices
+
+def map_palette(pixels, palette, space="rgb"):
+    # Replace every pixel with the nearest color of a fixed palette, the same colors postprocess.map_palette picks
+    # Searched exactly on every pixel, the lookup table only saves work on the CPU
+    dtype = float_dtype(pixels.device)
+    palette = torch.as_tensor(np.asarray(palette, dtype=np.uint8).reshape(-1, 3), device=pixels.device)
+    values, colors = pixels.to(dtype), palette.to(dtype)
+    if space == "oklab":
+        values, colors = srgb_to_oklab(values), srgb_to_oklab(colors)
+    return palette[nearest_palette(values, colors)]
+
+def bayer_dither(pixels, palette, threshold, order=8):
+    # Same ordered dithering as postprocess.bayer_dither
+    dtype = float_dtype(pixels.device)
+    palette = torch.as_tensor(np.asarray(palette, dtype=np.uint8).reshape(-1, 3), device=pixels.device)
+    height, width = pixels.shape[:2]
+
+    matrix = torch.as_tensor((1 + bayer_matrix(order)) / (1 + order * order), dtype=dtype, device=pixels.device)
+    tiled = matrix.repeat(height // order + 1, width // order + 1)[:height, :width]
+    offset = tiled[..., None] * torch.as_tensor(np.broadcast_to(threshold, 3).astype(np.int64) % 256, dtype=dtype, device=pixels.device)
+    return palette[nearest_palette(pixels.to(dtype) + offset, palette.to(dtype))]
+
+def palettize_frame(pixels, palette, colors, dithering, strength, denoise, smoothness, intensity, space="rgb", quantizer="pil"):
+    # Tensor counterpart of postprocess.palettize_frame
+    # Picking and quantizing to an adaptive palette and error diffusion have no tensor version and run on the CPU
+    device = pixels.device
+
+    # Apply denoising if enabled
+    if denoise == "true":
+        pixels = kDenoise(pixels, smoothness, intensity)
+
+    # Dithering is either the order of a Bayer matrix or the name of an error diffusion kernel
+    diffuse = dithering in DIFFUSION_KERNELS
+    dither = strength > 0 and (diffuse or dithering > 0)
+
+    # Calculate the threshold for dithering
+    threshold = 4*strength
+
+    if palette is not None:
+        if not dither:
+            return map_palette(pixels, palette, space)
+        gamma = 1.0-(0.02*strength)
+    else:
+        img = to_image(pixels)
+        if colors is None:
+            colors = determine_best_k(img, 64)
+        if colors <= 0:
+            return pixels
+
+        # Perform quantization, the colors it picks are the palette to dither with
+        if quantizer == "oklab":
+            img_indexed = quantize_oklab(img, colors)
+        else:
+            img_indexed = img.quantize(colors=colors, method=1, kmeans=colors, dither=0).convert('RGB')
+        if not dither:
+            return to_tensor(img_indexed, device)
+        palette = [color for _, color in img_indexed.getcolors(16777216)]
+        gamma = 1.0-(0.03*strength)
+
+    if diffuse:
+        # Spread the quantization error over the following pixels, strength 10 spreads all of it
+        return to_tensor(diffusion_dither(to_image(pixels), palette, dithering, min(strength/10, 1)), device)
+
+    # Perform ordered dithering using Bayer matrix on the gamma adjusted image
+    return bayer_dither(adjust_gamma(pixels, gamma), palette, threshold, order=dithering)
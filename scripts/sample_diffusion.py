@@ -8,7 +8,8 @@ from omegaconf import OmegaConf
 from PIL import Image
 
 from ldm.models.diffusion.ddim import DDIMSampler
-from ldm.util import instantiate_from_config
+from ldm.util import instantiate_from_config, init_missing
+from checkpoint import assign_state_dict, run_load_hooks
 
 rescale = lambda x: (x + 1.) / 2.
 
@@ -218,8 +219,14 @@ def get_parser():
 
 
 def load_model_from_config(config, sd):
-    model = instantiate_from_config(config)
-    model.load_state_dict(sd,strict=False)
+    # Skip the random initialization when every weight is about to be replaced by the checkpoint
+    model = instantiate_from_config(config, empty=sd is not None)
+    if sd is not None:
+        # The empty model has no weights to copy into, it takes the checkpoint tensors themselves
+        assign_state_dict(model, sd)
+        missing = [key for key in model.state_dict() if key not in sd]
+        init_missing(model, missing)
+        run_load_hooks(model, missing)
     model.cuda()
     model.eval()
     return model
@@ -0,0 +1,97 @@
+import pytest
+import torch
+
+from checkpoint import assign_state_dict, run_load_hooks, convert, find_split, load_split, read_header, stored_dtype, SUFFIX
+
+def original(tmp_path):
+    # A checkpoint with a tensor of every group, in the layout of the ones the server loads
+    path = str(tmp_path / "model.ckpt")
+    torch.save({"state_dict": {
+        "model.diffusion_model.input_blocks.0.weight": torch.randn(4, 4),
+        "model.diffusion_model.out.0.weight": torch.randn(4),
+        "cond_stage_model.transformer.weight": torch.randn(3),
+        "first_stage_model.decoder.weight": torch.randn(2, 2),
+        "betas": torch.linspace(0, 1, 5, dtype=torch.float64),
+    }}, path)
+    return path
+
+def test_split_round_trip(tmp_path):
+    path = original(tmp_path)
+    convert(path, path + SUFFIX, torch.float16)
+    groups = load_split(path + SUFFIX)
+    sd = torch.load(path)["state_dict"]
+    assert torch.equal(groups["model1"]["model1.diffusion_model.input_blocks.0.weight"], sd["model.diffusion_model.input_blocks.0.weight"].half())
+    assert torch.equal(groups["model2"]["model2.diffusion_model.out.0.weight"], sd["model.diffusion_model.out.0.weight"].half())
+    assert torch.equal(groups["first_stage_model"]["first_stage_model.decoder.weight"], sd["first_stage_model.decoder.weight"])
+    assert groups["common"]["betas"].dtype == torch.float32
+
+def test_split_precision(tmp_path):
+    path = original(tmp_path)
+    convert(path, path + SUFFIX, torch.float16)
+    assert read_header(path + SUFFIX)[0]["dtype"] == "float16"
+    assert find_split(path, torch.float16) == path + SUFFIX
+    # Full precision loads skip a half precision copy while the original is there
+    assert find_split(path, torch.float32) is None
+
+    convert(path, path + SUFFIX, torch.float32)
+    assert find_split(path, torch.float16) == path + SUFFIX
+    assert find_split(path, torch.float32) == path + SUFFIX
+
+def test_split_precision_of_older_files(tmp_path):
+    # Files converted before the header recorded it are read off their UNet tensors
+    path = original(tmp_path)
+    convert(path, path + SUFFIX, torch.float16)
+    header, _ = read_header(path + SUFFIX)
+    del header["dtype"]
+    assert stored_dtype(header) == torch.float16
+
+def test_split_without_original(tmp_path):
+    path = original(tmp_path)
+    convert(path, path + SUFFIX, torch.float16)
+    (tmp_path / "model.ckpt").unlink()
+    assert find_split(path, torch.float32) == path + SUFFIX
+
+def test_empty_modules_take_checkpoint_tensors():
+    pytest.importorskip("einops")
+    from ldm.util import skip_init, init_missing
+    with skip_init():
+        module = torch.nn.Sequential(torch.nn.Linear(4, 3), torch.nn.GroupNorm(1, 3))
+    assert all(tensor.is_meta for tensor in module.parameters())
+    # Constructors and initialization are back to normal afterwards
+    assert not torch.nn.Linear(2, 2).weight.is_meta
+
+    sd = {"0.weight": torch.randn(3, 4, dtype=torch.float16), "0.bias": torch.randn(3, dtype=torch.float16)}
+    assign_state_dict(module, sd)
+    init_missing(module, [key for key in module.state_dict() if key not in sd])
+    assert module[0].weight.data_ptr() == sd["0.weight"].data_ptr()
+    assert torch.equal(module[1].weight, torch.ones(3)) and torch.equal(module[1].bias, torch.zeros(3))
+    assert not any(tensor.is_meta for tensor in module.parameters())
+
+def test_load_hooks_see_assigned_tensors():
+    # A module deriving a tensor from loaded ones in a load_state_dict post hook, like splitAttention's SelfAttention
+    class Fused(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.a = torch.nn.Linear(2, 2, bias=False)
+            self.b = torch.nn.Linear(2, 2, bias=False)
+            self.fused = torch.nn.Parameter(torch.zeros(4, 2))
+            self.register_load_state_dict_post_hook(lambda module, keys: setattr(module.fused, "data", torch.cat([module.a.weight, module.b.weight])))
+
+    sd = {"a.weight": torch.ones(2, 2), "b.weight": torch.full((2, 2), 2.0)}
+    module = run_load_hooks(assign_state_dict(Fused(), sd), ["fused"])
+    assert torch.equal(module.fused, torch.cat([sd["a.weight"], sd["b.weight"]]))
+
+def test_empty_attention_takes_checkpoint_tensors():
+    pytest.importorskip("einops")
+    from ldm.util import skip_init, init_missing
+    with skip_init():
+        module = torch.nn.MultiheadAttention(4, 2)
+    assert all(tensor.is_meta for tensor in module.parameters())
+
+    # A checkpoint with the output projection but not the fused input projection
+    sd = {"out_proj.weight": torch.randn(4, 4), "out_proj.bias": torch.randn(4)}
+    assign_state_dict(module, sd)
+    init_missing(module, [key for key in module.state_dict() if key not in sd])
+    assert not any(tensor.is_meta for tensor in module.parameters())
+    assert torch.equal(module.in_proj_bias, torch.zeros(12))
+    assert module.out_proj.bias.data_ptr() == sd["out_proj.bias"].data_ptr() and torch.equal(module.out_proj.bias, sd["out_proj.bias"])
@@ -0,0 +1,116 @@
+import asyncio
+import time
+
+import jobqueue
+from jobqueue import Job, JobQueue
+
+# Stand-ins with the signatures of the server's txt2img and load jobs
+def txt2img(pixel, device, precision, prompt, negative, W, H, ddim_steps, scale, seed, n_iter, tilingX, tilingY, save=True, cancel=None, preview=None):
+    pass
+
+def load(message, path, modelfile, device, precision, optimized):
+    pass
+
+jobqueue.batchable.append(txt2img)
+
+def generation(client, n_iter=1, save=False, W=512):
+    return Job(client, "rgba", "running txt2img", "returning txt2img", txt2img, "true", "cuda", "autocast", "a tree", "", W, 512, 20, 7.0, 1, n_iter, "false", "false", save=save)
+
+def model(client):
+    return Job(client, "rgba", "loading model", "loaded model", load, "load ...", "models", "other.ckpt", "cuda", "autocast", "true")
+
+def gathered(*queued):
+    # Put the jobs into a fresh queue, take the first one off it like the worker does and gather its batch
+    async def run():
+        jobs = JobQueue()
+        for job in queued:
+            jobs.put(job)
+        batch = await jobs.gather(await jobs.get())
+        return batch, list(jobs.pending)
+    return asyncio.run(run())
+
+def test_load_ends_the_batch():
+    first, switch, second = generation("a"), model("b"), generation("b")
+    batch, pending = gathered(first, switch, second)
+    assert batch == [first]
+    assert pending == [switch, second]
+
+class Token:
+    # Cancellation flag like the server's CancelToken
+    def __init__(self):
+        self.cancelled = False
+
+def test_batch_keeps_submission_order():
+    queued = [generation(client) for client in "abcd"]
+    batch, pending = gathered(*queued)
+    assert batch == queued
+    assert pending == []
+
+def test_incompatible_jobs_are_skipped():
+    first, larger, second = generation("a"), generation("b", W=768), generation("c")
+    batch, pending = gathered(first, larger, second)
+    assert batch == [first, second]
+    assert pending == [larger]
+
+def test_batch_stops_at_batch_max():
+    queued = [generation(client, n_iter=3) for client in "abcd"]
+    batch, pending = gathered(*queued)
+    assert batch == queued[:2]
+    assert pending == queued[2:]
+    assert sum(job.arguments()["n_iter"] for job in batch) <= jobqueue.batch_max
+
+def test_smaller_job_fills_the_batch():
+    first, big, small = generation("a", n_iter=4), generation("b", n_iter=5), generation("c", n_iter=4)
+    batch, pending = gathered(first, big, small)
+    assert batch == [first, small]
+    assert pending == [big]
+
+def test_saved_jobs_are_never_merged():
+    saved, other = generation("a", save=True), generation("b")
+    batch, pending = gathered(saved, other)
+    assert batch == [saved]
+    assert pending == [other]
+
+    first, saved = generation("a"), generation("b", save=True)
+    batch, pending = gathered(first, saved)
+    assert batch == [first]
+    assert pending == [saved]
+
+def test_cancelled_jobs_are_dropped():
+    queued = [generation(client) for client in "abc"]
+    queued[1].cancel = Token()
+    queued[1].cancel.cancelled = True
+    batch, _ = gathered(*queued)
+    assert jobqueue.cancelled_jobs(batch) == [queued[1]]
+
+def test_finished_jobs_release_their_token():
+    own, other = Token(), Token()
+    tokens = [own, other]
+    first = Job("a", "rgba", "running txt2img", "returning txt2img", txt2img, "true", "cuda", "autocast", "a tree", "", 512, 512, 20, 7.0, 1, 1, "false", "false", save=False, cancel=own, tokens=tokens)
+    assert "tokens" not in first.arguments()
+    first.finish()
+    assert tokens == [other]
+    # Tokens a cancel message already cleared are left alone
+    tokens.clear()
+    first.finish()
+    assert tokens == []
+
+def test_lone_job_does_not_wait(monkeypatch):
+    monkeypatch.setattr(jobqueue, "batch_window", 10)
+    first, switch = generation("a"), model("b")
+    start = time.perf_counter()
+    batch, pending = gathered(first, switch)
+    assert time.perf_counter() - start < 1
+    assert batch == [first]
+    assert pending == [switch]
+
+def test_batch_waits_for_late_jobs():
+    async def run():
+        jobs = JobQueue()
+        first, second, late = generation("a"), generation("b"), generation("c")
+        jobs.put(first)
+        jobs.put(second)
+        asyncio.get_event_loop().call_later(jobqueue.batch_window / 5, jobs.put, late)
+        return await jobs.gather(await jobs.get()), [first, second, late]
+    batch, queued = asyncio.run(run())
+    assert batch == queued
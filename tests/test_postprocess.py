@@ -0,0 +1,270 @@
+from itertools import product
+from pathlib import Path
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import postprocess
+
+# kCentroid and kDenoise cluster every block at once instead of running PIL's k-means quantizer on it. They follow
+# PIL's steps, so they only pick a different color in the rare blocks PIL handles by the order of its internal color
+# hash table in a way they don't copy. Checked here against doing exactly that: on photos at most 1% of the pixels
+# differ, they cluster every block about as tightly as PIL does, and pick the same color where one covers most of a block
+
+def kCentroid_reference(image, width, height, centroids):
+    image = image.convert("RGB")
+    downscaled = np.zeros((height, width, 3), dtype=np.uint8)
+    wFactor = image.width/width
+    hFactor = image.height/height
+    for x, y in product(range(width), range(height)):
+        tile = image.crop((x*wFactor, y*hFactor, (x*wFactor)+wFactor, (y*hFactor)+hFactor))
+        tile = tile.quantize(colors=centroids, method=1, kmeans=centroids).convert("RGB")
+        color_counts = tile.getcolors()
+        downscaled[y, x, :] = max(color_counts, key=lambda x: x[0])[1]
+    return Image.fromarray(downscaled, mode="RGB")
+
+def kDenoise_reference(image, smoothing, strength):
+    image = image.convert("RGB")
+    denoised = np.zeros((image.height, image.width, 3), dtype=np.uint8)
+    for x, y in product(range(image.width), range(image.height)):
+        tile = image.crop((x-1, y-1, min(x+2, image.width), min(y+2, image.height)))
+        centroids = max(2, min(round((tile.width*tile.height)*(1/strength)), (tile.width*tile.height)))
+        tile = tile.quantize(colors=centroids, method=1, kmeans=centroids).convert("RGB")
+        color_counts = tile.getcolors()
+        final_color = tile.getpixel((1, 1))
+        count = 0
+        for ele in color_counts:
+            if ele[1] == final_color:
+                count = ele[0]
+        if count < 1+round(((tile.width*tile.height)*0.8)*(smoothing/10)):
+            final_color = max(color_counts, key=lambda x: x[0])[1]
+        denoised[y, x, :] = final_color
+    return Image.fromarray(denoised, mode="RGB")
+
+def strip_palette_reference(image, strip, colors):
+    image = kCentroid_reference(image, int(image.width/strip), 1, 2)
+    palette = Image.new('P', (colors, 1))
+    for x in range(image.width):
+        for y in range(image.height):
+            r, g, b = image.getpixel((x, y))
+
+            palette.putpixel((x, y), (r, g, b))
+    return palette
+
+def quantize_error_reference(image, width, height, centroids):
+    # Summed squared error of quantizing every block with PIL
+    image = image.convert("RGB")
+    wFactor = image.width/width
+    hFactor = image.height/height
+    error = 0.0
+    for x, y in product(range(width), range(height)):
+        tile = image.crop((x*wFactor, y*hFactor, (x*wFactor)+wFactor, (y*hFactor)+hFactor))
+        quantized = tile.quantize(colors=centroids, method=1, kmeans=centroids).convert("RGB")
+        error += ((np.asarray(tile, dtype=np.float64) - np.asarray(quantized, dtype=np.float64)) ** 2).sum()
+    return error
+
+def quantize_error(image, width, height, centroids):
+    # Summed squared error of quantizing every block with kmeans_blocks
+    pixels = np.asarray(image.convert("RGB"))
+    xs, xe = postprocess.block_bounds(pixels.shape[1], width)
+    ys, ye = postprocess.block_bounds(pixels.shape[0], height)
+    blocks, mask = postprocess.block_view(pixels, xs, xe, ys, ye)
+    blocks, mask = blocks.reshape(-1, blocks.shape[2], 3), mask.reshape(-1, mask.shape[2])
+    colors, _, labels = postprocess.kmeans_blocks(blocks, mask, centroids)
+    quantized = np.take_along_axis(colors, np.minimum(labels, centroids - 1)[..., None], 1)
+    return float((((blocks.astype(np.float64) - quantized) ** 2).sum(-1) * mask).sum())
+
+def images(size):
+    rng = np.random.default_rng(0)
+    # Noise, every block is full of distinct colors
+    yield Image.fromarray(rng.integers(0, 256, (size, size, 3), dtype=np.uint8))
+    # Upscaled pixel art with a little noise, blocks hold a few colors with many repeats and ties
+    palette = rng.integers(0, 256, (6, 3))
+    art = np.kron(palette[rng.integers(0, 6, (size // 4, size // 4))], np.ones((4, 4, 1)))
+    yield Image.fromarray(np.clip(art + rng.normal(0, 4, art.shape), 0, 255).astype(np.uint8))
+    # Flat areas of a handful of exact colors
+    yield Image.fromarray(palette[rng.integers(0, 3, (size, size))].astype(np.uint8))
+
+def majority(size, block):
+    # Pixel art upscaled by block with up to a quarter of the pixels of every block in a second color,
+    # so the most common color of each block is never in doubt
+    rng = np.random.default_rng(1)
+    palette = rng.integers(0, 256, (6, 3))
+    upscale = np.ones((block, block), dtype=np.int64)
+    art = np.kron(rng.integers(0, 6, (size // block, size // block)), upscale)
+    second = np.kron(rng.integers(0, 6, (size // block, size // block)), upscale)
+    art = np.where(rng.random(art.shape) < 0.25, second, art)
+    return Image.fromarray(palette[art].astype(np.uint8))
+
+def speckled(size, block, amount=0.03):
+    # Pixel art upscaled by block with a few scattered pixels of other colors, the noise kDenoise is meant to remove
+    rng = np.random.default_rng(2)
+    palette = rng.integers(0, 256, (6, 3))
+    art = np.kron(rng.integers(0, 6, (size // block, size // block)), np.ones((block, block), dtype=np.int64))
+    art = np.where(rng.random(art.shape) < amount, rng.integers(0, 6, art.shape), art)
+    return Image.fromarray(palette[art].astype(np.uint8))
+
+def sprite(width, height, seed):
+    # Pixel art of flat color regions, rectangles and ellipses of a few colors over a background
+    rng = np.random.default_rng(seed)
+    palette = rng.integers(0, 256, (6, 3))
+    y, x = np.mgrid[:height, :width]
+    art = np.zeros((height, width), dtype=np.int64)
+    for _ in range(16):
+        cx, cy = rng.integers(0, width), rng.integers(0, height)
+        rx, ry = rng.integers(1, width // 4 + 1), rng.integers(1, height // 4 + 1)
+        if rng.random() < 0.5:
+            inside = ((x - cx) / rx) ** 2 + ((y - cy) / ry) ** 2 <= 1
+        else:
+            inside = (np.abs(x - cx) <= rx) & (np.abs(y - cy) <= ry)
+        art[inside] = rng.integers(1, 6)
+    return Image.fromarray(palette[art].astype(np.uint8))
+
+def upscaled(image, x, y):
+    # Image upscaled by x and y with nearest neighbour resizing, one pixel cut off the top and left edge
+    # where the first blocks stay more than half visible so the grid no longer starts at the corner
+    image = image.resize((round(image.width * x), round(image.height * y)), Image.NEAREST)
+    return image.crop((1, 1, image.width, image.height)) if min(x, y) >= 3 else image
+
+def photos(size):
+    # Sample images of the repository scaled to size
+    assets = Path(__file__).resolve().parent.parent / "assets"
+    for name in ["stable-samples/txt2img/000002025.png", "stable-samples/img2img/mountains-1.png", "birdhouse.png"]:
+        yield Image.open(assets / name).convert("RGB").resize((size, size))
+
+def torch_backend():
+    torch = pytest.importorskip("torch")
+    import postprocess_torch
+    return torch, postprocess_torch
+
+@pytest.mark.parametrize("centroids", [2, 3, 4])
+@pytest.mark.parametrize("width, height", [(16, 16), (12, 10)])
+def test_kmeans_blocks_as_tight_as_pil(width, height, centroids):
+    for image in images(64):
+        assert quantize_error(image, width, height, centroids) <= 1.05 * quantize_error_reference(image, width, height, centroids)
+
+@pytest.mark.parametrize("centroids", [2, 3, 4])
+@pytest.mark.parametrize("width, height", [(64, 64), (96, 80)])
+def test_kCentroid_close_to_pil_on_photos(width, height, centroids):
+    for image in photos(512):
+        expected = np.asarray(kCentroid_reference(image, width, height, centroids))
+        same = (np.asarray(postprocess.kCentroid(image, width, height, centroids)) == expected).all(-1)
+        assert same.mean() >= 0.99
+
+@pytest.mark.parametrize("centroids", [2, 3, 4])
+def test_kCentroid_picks_majority_like_pil(centroids):
+    image = majority(64, 8)
+    expected = np.asarray(kCentroid_reference(image, 8, 8, centroids))
+    assert np.array_equal(np.asarray(postprocess.kCentroid(image, 8, 8, centroids)), expected)
+
+@pytest.mark.parametrize("smoothing, strength", [(10, 50), (0, 2), (5, 4), (10, 1), (3, 1)])
+def test_kDenoise_close_to_pil(smoothing, strength):
+    # Windows only differ from PIL where several colors tie for the most pixels
+    image = speckled(48, 8)
+    expected = np.asarray(kDenoise_reference(image, smoothing, strength))
+    same = (np.asarray(postprocess.kDenoise(image, smoothing, strength)) == expected).all(-1)
+    assert same.mean() >= 0.99
+
+@pytest.mark.parametrize("smoothing", [1, 5, 10])
+def test_kDenoise_keeps_noise_in_place(smoothing):
+    # At full strength every color of noise is alone in its window, a tie that must not shift the image toward a corner.
+    # Windows on the top and left edge see black beyond it, which outnumbers their other colors
+    image = next(images(48))
+    assert np.array_equal(np.asarray(postprocess.kDenoise(image, smoothing, 1))[1:, 1:], np.asarray(image)[1:, 1:])
+
+@pytest.mark.parametrize("centroids", [2, 3, 4])
+@pytest.mark.parametrize("width, height", [(16, 16), (12, 10)])
+def test_kCentroid_torch_matches_numpy(width, height, centroids):
+    torch, postprocess_torch = torch_backend()
+    for image in images(64):
+        expected = np.asarray(postprocess.kCentroid(image, width, height, centroids))
+        pixels = postprocess_torch.to_tensor(image)
+        assert np.array_equal(np.asarray(postprocess_torch.to_image(postprocess_torch.kCentroid(pixels, width, height, centroids))), expected)
+
+@pytest.mark.parametrize("centroids", [2, 4])
+def test_kCentroid_torch_matches_numpy_on_photos(centroids):
+    torch, postprocess_torch = torch_backend()
+    for image in photos(512):
+        expected = np.asarray(postprocess.kCentroid(image, 96, 80, centroids))
+        pixels = postprocess_torch.to_tensor(image)
+        assert np.array_equal(np.asarray(postprocess_torch.to_image(postprocess_torch.kCentroid(pixels, 96, 80, centroids))), expected)
+
+@pytest.mark.parametrize("smoothing, strength", [(10, 50), (0, 2), (5, 4), (10, 1)])
+def test_kDenoise_torch_matches_numpy(smoothing, strength):
+    torch, postprocess_torch = torch_backend()
+    for image in images(24):
+        expected = np.asarray(postprocess.kDenoise(image, smoothing, strength))
+        pixels = postprocess_torch.to_tensor(image)
+        assert np.array_equal(np.asarray(postprocess_torch.to_image(postprocess_torch.kDenoise(pixels, smoothing, strength))), expected)
+
+@pytest.mark.parametrize("x, y", [(2, 2), (3, 3), (4, 4), (8, 8), (2.5, 2.5), (3.5, 3.5), (4.33, 4.33), (6.4, 6.4), (3, 4), (2.5, 6)])
+def test_detect_grid_finds_upscaled_sprites(x, y):
+    # Nearest neighbour resizing rounds exact halves either way, which may move a block edge of non-integer scales by a pixel
+    for seed in range(5):
+        image = sprite(48, 40, seed)
+        upscale = upscaled(image, x, y)
+        xgrid, ygrid, confidence = postprocess.detect_grid(upscale)
+        assert abs(xgrid[0] - x) < 0.02 * x and abs(ygrid[0] - y) < 0.02 * y
+        assert confidence >= 0.5
+        downscaled = np.asarray(postprocess.grid_downscale(upscale, xgrid, ygrid))
+        assert downscaled.shape == np.asarray(image).shape
+        assert (downscaled == np.asarray(image)).all(-1).mean() >= 0.99
+
+def test_detect_grid_finds_no_grid():
+    rng = np.random.default_rng(3)
+    noise = Image.fromarray(rng.integers(0, 256, (200, 300, 3), dtype=np.uint8))
+    gradient = Image.fromarray(np.stack(np.meshgrid(np.arange(300) % 256, np.arange(200) % 256) + [np.zeros((200, 300), dtype=np.int64)], -1).astype(np.uint8))
+    for image in [noise, gradient, *photos(512)]:
+        x, y, confidence = postprocess.detect_grid(image)
+        assert x == y == (1.0, 0.0)
+        assert confidence < 0.25
+
+@pytest.mark.parametrize("colors", [3, 5, 6, 12, 24, 101])
+def test_strip_palette_matches_pixel_loop(colors):
+    # Strips of paletteGen's width with some colors repeated and a little noise, cut to a multiple of 8 pixels like decoded images
+    rng = np.random.default_rng(colors)
+    base = 2**round(np.log2(colors))
+    strip = 512/base
+    width = int(512+(strip*(colors-base))) // 8 * 8
+    swatches = rng.integers(0, 256, (colors, 3))
+    swatches[1::4] = swatches[0]
+    strips = np.repeat(swatches, int(strip), 0)[None, :width].repeat(64, 0)
+    image = Image.fromarray(np.clip(strips + rng.normal(0, 2, strips.shape).round(), 0, 255).astype(np.uint8))
+    expected = np.asarray(strip_palette_reference(image, strip, colors).convert("RGB"))
+    assert np.array_equal(np.asarray(postprocess.strip_palette(image, strip, colors).convert("RGB")), expected)
+
+def test_sample_frames_covers_every_frame():
+    # Four flat frames of different colors sample to about one frame of pixels holding all four colors
+    colors = [(255, 0, 0), (0, 255, 0), (0, 0, 255), (255, 255, 0)]
+    frames = [Image.new("RGB", (64, 48), color) for color in colors]
+    sample = postprocess.sample_frames(frames)
+    assert sample.width * sample.height == 64 * 48
+    assert sorted(color for _, color in sample.getcolors()) == sorted(colors)
+    assert np.array_equal(np.asarray(postprocess.sample_frames(frames[:1])).reshape(-1, 3), np.asarray(frames[0]).reshape(-1, 3))
+
+@pytest.mark.parametrize("space", ["rgb", "oklab"])
+@pytest.mark.parametrize("colors", [2, 16, 64])
+def test_map_palette_matches_exact_search(space, colors):
+    # The lookup table maps every pixel to the same palette color as searching the whole palette, also for
+    # palettes with colors close enough together to share a cell of the table
+    rng = np.random.default_rng(3)
+    image = Image.fromarray(rng.integers(0, 256, (128, 128, 3), dtype=np.uint8))
+    palette = rng.integers(0, 256, (colors, 3))
+    palette[colors // 2:] = np.clip(palette[:colors - colors // 2] + rng.integers(-3, 4, (colors // 2, 3)), 0, 255)
+    pixels, targets = np.asarray(image).reshape(-1, 3).astype(np.float64), palette.astype(np.float64)
+    if space == "oklab":
+        pixels, targets = postprocess.srgb_to_oklab(pixels), postprocess.srgb_to_oklab(targets)
+    expected = palette[((pixels[:, None] - targets) ** 2).sum(-1).argmin(-1)].reshape(128, 128, 3)
+    assert np.array_equal(np.asarray(postprocess.map_palette(image, palette, space=space)), expected)
+
+@pytest.mark.parametrize("space", ["rgb", "oklab"])
+def test_map_palette_torch_matches_numpy(space):
+    torch, postprocess_torch = torch_backend()
+    rng = np.random.default_rng(4)
+    image = Image.fromarray(rng.integers(0, 256, (128, 128, 3), dtype=np.uint8))
+    palette = rng.integers(0, 256, (32, 3))
+    palette[16:] = np.clip(palette[:16] + rng.integers(-3, 4, (16, 3)), 0, 255)
+    expected = np.asarray(postprocess.map_palette(image, palette, space=space))
+    pixels = postprocess_torch.to_tensor(image)
+    assert np.array_equal(np.asarray(postprocess_torch.to_image(postprocess_torch.map_palette(pixels, palette, space))), expected)